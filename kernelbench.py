@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the kernels of lnprob, with a stored baseline to catch
+slowdowns.
+
+USAGE
+
+ python $PYSRC/kernelbench.py save [baseline]
+ python $PYSRC/kernelbench.py compare [baseline] [threshold]
+
+ Every kernel is timed at several array sizes: lensutil.sie_grad,
+ gauss_2d, ellipse_2d and sbmap on square maps, grid.gcffun on tables of
+ ngcf entries, grid.ModCorr and the FFT (numpy.fft.fft2 of a complex
+ canvas) on padded canvases, and sample_vis.ModGrid1 and grid.ModShift for
+ numbers of visibilities.  Each time is the fastest of 5 repeats of as many
+ calls as take at least 0.1 s, per call.
+
+ "save" writes the times, with the versions used, to the JSON file baseline
+ (default kernelbench.json).  "compare" times the kernels again and prints
+ the ratio of every time to the baseline, flagging those more than threshold
+ (default 0.2, i.e. 20%) slower; the exit status is 1 if any is.  Baselines
+ are only comparable on the same machine, so save one before optimising and
+ compare after every change.
+"""
+
+import sys
+import json
+import time
+import platform
+import numpy
+import lensutil
+import grid
+import sample_vis
+
+repeats = 5
+mintime = 0.1
+
+# lens and source parameters for the map kernels
+lenspar = numpy.array([1.0, 0.05, -0.05, 0.8, 30.])
+sourcepar = numpy.array([1.0, 0.2, 0.1, 0.1, 0.7, 60.])
+
+
+def mapgrid(npix):
+    axis = numpy.linspace(-3., 3., npix)
+    return numpy.meshgrid(axis, axis)
+
+def bench_sie_grad(npix):
+    x, y = mapgrid(npix)
+    return lambda: lensutil.sie_grad(x, y, lenspar)
+
+def bench_gauss_2d(npix):
+    x, y = mapgrid(npix)
+    return lambda: lensutil.gauss_2d(x, y, sourcepar)
+
+def bench_ellipse_2d(npix):
+    x, y = mapgrid(npix)
+    return lambda: lensutil.ellipse_2d(x, y, sourcepar)
+
+def bench_sbmap(npix):
+    x, y = mapgrid(npix)
+    parameters = numpy.append(lenspar, sourcepar)
+    return lambda: lensutil.sbmap(x, y, 1, 1, parameters, ['gaussian'])
+
+def bench_gcffun(ngcf):
+    return lambda: grid.gcffun(ngcf, 6, 1.)
+
+def bench_ModCorr(nxd):
+    return lambda: grid.ModCorr(nxd, nxd)
+
+def bench_fft2(nxd):
+    image = numpy.random.normal(size=(nxd, nxd)) + 0j
+    return lambda: numpy.fft.fft2(image)
+
+def bench_ModGrid1(nvis):
+    nxd = 512
+    width = 6
+    ngcf = width * ((2048 - 1) / width) + 1
+    gcf = grid.gcffun(ngcf, width, 1.)
+    mvis = numpy.fft.fft2(numpy.random.normal(size=(nxd, nxd)))
+    umax = 0.5 * (nxd - 1 - width)
+    uu = numpy.random.uniform(-umax, umax, nvis)
+    vv = numpy.random.uniform(-umax, umax, nvis)
+    return lambda: sample_vis.ModGrid1(uu, vv, nxd / 2 + 1, nxd / 2 + 1, \
+            mvis, gcf, ngcf, nxd, width)
+
+def bench_ModShift(nvis):
+    ud = numpy.random.normal(size=nvis) * 1e5
+    vd = numpy.random.normal(size=nvis) * 1e5
+    mvis = numpy.random.normal(size=nvis) + 1j * numpy.random.normal(size=nvis)
+    return lambda: grid.ModShift(ud, vd, 1e-7, -1e-7, 2e-7, 1e-7, 1, 1, mvis)
+
+# each kernel, the sizes to time it at, and what the size counts
+kernels = [('sie_grad', bench_sie_grad, [64, 128, 256, 512], 'pixels'), \
+        ('gauss_2d', bench_gauss_2d, [64, 128, 256, 512], 'pixels'), \
+        ('ellipse_2d', bench_ellipse_2d, [64, 128, 256, 512], 'pixels'), \
+        ('sbmap', bench_sbmap, [64, 128, 256, 512], 'pixels'), \
+        ('gcffun', bench_gcffun, [511, 2047, 8191], 'entries'), \
+        ('ModCorr', bench_ModCorr, [128, 256, 512, 1024], 'pixels'), \
+        ('fft2', bench_fft2, [128, 256, 512, 1024], 'pixels'), \
+        ('ModGrid1', bench_ModGrid1, [1000, 10000, 100000], \
+        'visibilities'), \
+        ('ModShift', bench_ModShift, [1000, 10000, 100000], 'visibilities')]
+
+# seconds per call of fn: the fastest of repeats runs of enough calls to take
+# at least mintime
+def timecall(fn):
+    fn()
+    ncalls = 1
+    while True:
+        start = time.time()
+        for i in range(ncalls):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= mintime:
+            break
+        ncalls *= 2
+    best = elapsed
+    for repeat in range(repeats - 1):
+        start = time.time()
+        for i in range(ncalls):
+            fn()
+        best = min(best, time.time() - start)
+    return best / ncalls
+
+def runkernels():
+    numpy.random.seed(1)
+    keys = []
+    timings = {}
+    for name, setup, sizes, unit in kernels:
+        for size in sizes:
+            key = name + ' ' + str(size) + ' ' + unit
+            keys.append(key)
+            timings[key] = timecall(setup(size))
+            print key + ': ' + str(timings[key]) + ' s'
+    return keys, timings
+
+
+if len(sys.argv) < 2 or sys.argv[1] not in ['save', 'compare']:
+    sys.exit(__doc__)
+mode = sys.argv[1]
+if len(sys.argv) > 2:
+    baselineloc = sys.argv[2]
+else:
+    baselineloc = 'kernelbench.json'
+if len(sys.argv) > 3:
+    threshold = float(sys.argv[3])
+else:
+    threshold = 0.2
+
+if mode == 'save':
+    keys, timings = runkernels()
+    environment = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), \
+            'host': platform.node(), 'python': platform.python_version(), \
+            'numpy': numpy.__version__}
+    baselinefile = open(baselineloc, 'w')
+    json.dump({'environment': environment, 'timings': timings}, \
+            baselinefile, indent=1, sort_keys=True)
+    baselinefile.close()
+    print 'Baseline written to ' + baselineloc
+    sys.exit(0)
+
+baseline = json.load(open(baselineloc))
+if baseline['environment']['host'] != platform.node():
+    print 'Warning: the baseline was timed on ' + \
+            baseline['environment']['host']
+keys, timings = runkernels()
+print ''
+slower = []
+for key in keys:
+    if key not in baseline['timings']:
+        print key + ': not in the baseline'
+        continue
+    ratio = timings[key] / baseline['timings'][key]
+    line = key + ': ' + str(ratio) + ' times the baseline'
+    if ratio > 1 + threshold:
+        line += '  SLOWER'
+        slower.append(key)
+    print line
+if len(slower) > 0:
+    sys.exit(str(len(slower)) + ' kernel timings are more than ' + \
+            str(100 * threshold) + '% slower than ' + baselineloc)
+print 'No kernel is more than ' + str(100 * threshold) + '% slower than ' + \
+        baselineloc
@@ -15,6 +15,7 @@
 #
 
 import numpy as N
+import stagetimer
 
 def xy_rotate(x, y, xcen, ycen, phi):
     """
@@ -143,6 +144,48 @@ def gauss_2d(x, y, par):
     expgauss = N.exp(-0.5*r_ell_sq)
     return par[0] * expgauss
 
+def gauss_2d_grad(x, y, par):
+    """
+    NAME: gauss_2d_grad
+
+    PURPOSE: Evaluate a 2D Gaussian and its derivatives with respect to its
+             parameters and to the coordinates
+
+    USAGE: (z, dzdpar, dzdx, dzdy) = gauss_2d_grad(x, y, par)
+
+    ARGUMENTS:
+      x, y: vecors or images of coordinates;
+            should be matching numpy ndarrays
+      par: vector of parameters, as for gauss_2d
+
+    RETURNS: gauss_2d(x, y, par), the array of its derivatives with respect
+             to par[0] ... par[5] (shape (6,) + x.shape), and its derivatives
+             with respect to x and y
+    """
+    phirad = N.deg2rad(par[5] + 90)
+    cosphi = N.cos(phirad)
+    sinphi = N.sin(phirad)
+    (xnew,ynew) = xy_rotate(x, y, -par[2], par[3], par[5] + 90)
+    sigmasq = N.abs(par[1])**2
+    r_ell_sq = ((xnew**2)*par[4] + (ynew**2)/par[4]) / sigmasq
+    expgauss = N.exp(-0.5*r_ell_sq)
+    z = par[0] * expgauss
+
+    # chain rule through r_ell_sq and the rotated coordinates
+    dzdr = -0.5 * z
+    drdxnew = 2 * xnew * par[4] / sigmasq
+    drdynew = 2 * ynew / par[4] / sigmasq
+    dzdx = dzdr * (drdxnew * cosphi - drdynew * sinphi)
+    dzdy = dzdr * (drdxnew * sinphi + drdynew * cosphi)
+    dzdpar = N.zeros((6,) + N.shape(x))
+    dzdpar[0] = expgauss
+    dzdpar[1] = dzdr * (-2 * r_ell_sq / par[1])
+    dzdpar[2] = dzdx
+    dzdpar[3] = -dzdy
+    dzdpar[4] = dzdr * ((xnew**2) - (ynew**2)/par[4]**2) / sigmasq
+    dzdpar[5] = dzdr * (drdxnew * ynew - drdynew * xnew) * N.pi / 180
+    return z, dzdpar, dzdx, dzdy
+
 def sie_grad(x, y, par):
     """
     NAME: sie_grad
@@ -224,8 +267,79 @@ def sie_grad(x, y, par):
     # Return value:
     return (xg, yg, mu)
 
-def sbmap(x, y, nlens, nsource, parameters, model_types):
+def footprint(x, y, par, nsigma):
+    """
+    NAME: footprint
+
+    PURPOSE: Find the pixels whose coordinates fall inside a bounding box of
+             half-width nsigma times the largest axis of a source
+
+    USAGE: indx = footprint(x, y, par, nsigma)
+
+    ARGUMENTS:
+      x, y: vectors or images of coordinates;
+            should be matching numpy ndarrays
+      par: vector of source parameters, as for gauss_2d
+      nsigma: half-width of the bounding box in units of the
+              intermediate-axis sigma
+
+    RETURNS: flat indices of the pixels inside the bounding box
+    """
+    q = N.abs(par[4])
+    reach = nsigma * N.abs(par[1]) * max(N.sqrt(q), 1. / N.sqrt(q))
+    inside = (N.abs(x + par[2]) < reach) & (N.abs(y - par[3]) < reach)
+    return N.flatnonzero(inside)
+
+def render(x, y, par, model_type, nsigma=None):
+    """
+    NAME: render
 
+    PURPOSE: Evaluate a source profile, optionally only inside its footprint
+
+    USAGE: z = render(x, y, par, model_type, nsigma=None)
+
+    ARGUMENTS:
+      x, y: vectors or images of coordinates;
+            should be matching numpy ndarrays
+      par: vector of source parameters, as for gauss_2d
+      model_type: 'gaussian' or 'cylinder'
+      nsigma: (optional) if given, only pixels within nsigma of the source
+              center are evaluated and the rest are set to zero.  Cylinders
+              are always evaluated out to at least their edge.
+
+    RETURNS: source profile evaluated at x-y coords
+    """
+    if model_type == 'gaussian':
+        profile = gauss_2d
+    if model_type == 'cylinder':
+        profile = ellipse_2d
+        if nsigma is not None:
+            nsigma = max(nsigma, 1.)
+    if nsigma is None:
+        return profile(x, y, par)
+    image = N.zeros(x.shape)
+    indx = footprint(x, y, par, nsigma)
+    if indx.size > 0:
+        image.flat[indx] = profile(x.flat[indx], y.flat[indx], par)
+    return image
+
+def deflect(x, y, nlens, parameters):
+    """
+    NAME: deflect
+
+    PURPOSE: Sum the deflections and magnifications of all the SIE lenses
+
+    USAGE: (dx, dy, dmu) = deflect(x, y, nlens, parameters)
+
+    ARGUMENTS:
+      x, y: vectors or images of coordinates;
+            should be matching numpy ndarrays
+      nlens: number of lenses
+      parameters: 5 parameters per lens, as for sie_grad
+
+    RETURNS: tuple (dx, dy, dmu) of summed gradients and magnifications at
+             the positions (x, y)
+    """
     # define the x, y, and magnification maps
     dx = N.zeros(x.shape)
     dy = N.zeros(y.shape)
@@ -250,6 +364,190 @@ def sbmap(x, y, nlens, nsource, parameters, model_types):
         dy += yg
         dmu += mu
 
+    return dx, dy, dmu
+
+def refineindx(image, dx, dy, par, dmu, muthresh=10., gradthresh=0.1, \
+        sizethresh=0.35, reach=4.):
+    """
+    NAME: refineindx
+
+    PURPOSE: Flag the pixels of a lensed image that need sub-pixel sampling.
+             A pixel is refined if its patch of the source plane comes within
+             reach sigma of the source and either is larger than sizethresh
+             times the source's minor-axis sigma or lies near a critical
+             curve, where the magnification exceeds muthresh.  Pixels where
+             the image changes by more than gradthresh times its peak from
+             one pixel to the next (such as the edges of cylinders) are
+             refined too.
+
+    USAGE: indx = refineindx(image, dx, dy, par, dmu)
+
+    ARGUMENTS:
+      image: lensed surface brightness map
+      dx, dy, dmu: deflections and magnification map from deflect
+      par: vector of source parameters, as for gauss_2d
+      muthresh: (optional) magnification above which pixels are refined
+      gradthresh: (optional) pixel-to-pixel change, as a fraction of the
+                  peak, above which pixels are refined
+      sizethresh: (optional) size of the patch of the source plane, as a
+                  fraction of the minor-axis sigma, above which pixels are
+                  refined
+      reach: (optional) distance from the source, in units of its major-axis
+             sigma, within which pixels may be refined
+
+    RETURNS: flat indices of the flagged pixels
+
+    NOTES: The patch of the source plane traced by a pixel is estimated from
+      the deflections of its neighbours, so that sources smaller than a pixel
+      are caught even when no pixel center traces onto them.
+    """
+    # half-size of the patch of the source plane traced by each pixel
+    halfx = 0.5 * (N.abs(N.gradient(dx, axis=0)) + \
+            N.abs(N.gradient(dx, axis=1)))
+    halfy = 0.5 * (N.abs(N.gradient(dy, axis=0)) + \
+            N.abs(N.gradient(dy, axis=1)))
+
+    q = N.abs(par[4])
+    major = N.abs(par[1]) * max(N.sqrt(q), 1. / N.sqrt(q))
+    minor = N.abs(par[1]) * min(N.sqrt(q), 1. / N.sqrt(q))
+    near = (N.abs(dx + par[2]) < reach * major + halfx) & \
+            (N.abs(dy - par[3]) < reach * major + halfy)
+    coarse = N.maximum(halfx, halfy) > sizethresh * minor
+    flag = near & (coarse | (dmu > muthresh))
+
+    peak = image.max()
+    if peak > 0:
+        gy, gx = N.gradient(image)
+        flag |= N.hypot(gx, gy) > gradthresh * peak
+    return N.flatnonzero(flag)
+
+def subpixels(x, y, indx, nsub):
+    """
+    NAME: subpixels
+
+    PURPOSE: Divide the selected pixels of a regular coordinate grid into
+             nsub x nsub sub-pixels
+
+    USAGE: (sx, sy) = subpixels(x, y, indx, nsub)
+
+    ARGUMENTS:
+      x, y: images of coordinates, as used by sbmap
+      indx: flat indices of the pixels to divide
+      nsub: number of sub-pixels along each axis
+
+    RETURNS: tuple (sx, sy) of sub-pixel coordinates, with one row of
+             nsub**2 sub-pixels per selected pixel
+    """
+    xstep = x[0, 1] - x[0, 0]
+    ystep = y[1, 0] - y[0, 0]
+    offset = (N.arange(nsub) + 0.5) / nsub - 0.5
+    xoff, yoff = N.meshgrid(offset * xstep, offset * ystep)
+    sx = x.flat[indx][:, N.newaxis] + xoff.ravel()
+    sy = y.flat[indx][:, N.newaxis] + yoff.ravel()
+    return sx, sy
+
+def subpixelmean(x, y, par, model_type, nsigma, nsub):
+    """
+    NAME: subpixelmean
+
+    PURPOSE: Render an unlensed source on an nsub x nsub sub-pixel grid and
+             average it back to the pixels of a regular coordinate grid
+
+    USAGE: z = subpixelmean(x, y, par, model_type, nsigma, nsub)
+
+    ARGUMENTS:
+      x, y: images of coordinates, as used by sbmap
+      par, model_type, nsigma: as for render
+      nsub: number of sub-pixels along each axis
+
+    RETURNS: mean of the source profile over the sub-pixels of each pixel
+    """
+    xstep = x[0, 1] - x[0, 0]
+    ystep = y[1, 0] - y[0, 0]
+    offset = (N.arange(nsub) + 0.5) / nsub - 0.5
+    image = N.zeros(x.shape)
+    for yoff in offset * ystep:
+        for xoff in offset * xstep:
+            image += render(x + xoff, y + yoff, par, model_type, nsigma)
+    return image / nsub**2
+
+def smallestcrop(images, crops, tolerance):
+    """
+    NAME: smallestcrop
+
+    PURPOSE: Find the smallest of a set of central crops of a map that holds
+             all but a fraction tolerance of the flux of each of its images
+
+    USAGE: icrop = smallestcrop(images, crops, tolerance)
+
+    ARGUMENTS:
+      images: list of rendered maps, such as the lensed maps of the sources
+      crops: list of slices, smallest first, each applied to both axes
+      tolerance: largest fraction of the flux of any image that a crop may
+                 leave out
+
+    RETURNS: index of the smallest crop that qualifies, or None if none does
+
+    NOTES: The crop is chosen from the maps actually rendered, because
+      lensed emission can reach far beyond the Einstein radius and the
+      source offsets.  sbmap evaluates the sources at the deflections,
+      which are about the Einstein radius everywhere, so a lensed map
+      usually reaches its edge and only unlensed maps are cropped.  The
+      full map is rendered either way; a crop saves the FFT and the
+      degridding only.
+    """
+    totals = [N.abs(image).sum() for image in images]
+    for icrop in range(len(crops)):
+        crop = crops[icrop]
+        for image, total in zip(images, totals):
+            if N.abs(image[crop, crop]).sum() < (1 - tolerance) * total:
+                break
+        else:
+            return icrop
+    return None
+
+def sbmap(x, y, nlens, nsource, parameters, model_types, nsigma=None, \
+        nsub=1, muthresh=10., gradthresh=0.1, sizethresh=0.35, \
+        separate=False):
+    """
+    NAME: sbmap
+
+    PURPOSE: Ray-trace the image plane through the lens(es) and render the
+             unlensed and lensed surface brightness maps of the sources
+
+    USAGE: (g_image, g_lensimage, e_image, e_lensimage, amp_tot, amp_mask) =
+           sbmap(x, y, nlens, nsource, parameters, model_types)
+
+    ARGUMENTS:
+      x, y: images of coordinates; should be matching numpy ndarrays
+      nlens, nsource: number of lenses and sources
+      parameters: 5 parameters per lens followed by 6 per source
+      model_types: 'gaussian' or 'cylinder' for each source
+      nsigma: (optional) only render sources on the pixels whose traced
+              coordinates lie within nsigma of the source center, so that
+              the cost scales with the lensed area instead of the map area.
+              Everything else is left at zero.
+      nsub: (optional) if greater than 1, the lensed pixels flagged by
+            refineindx (using muthresh, gradthresh and sizethresh) are
+            re-traced on an nsub x nsub sub-pixel grid and replaced by the
+            sub-pixel mean, and the unlensed map used for the flux
+            normalization is averaged over the same sub-pixels.  This gives
+            the accuracy of a uniformly oversampled map at a fraction of the
+            cost.
+      separate: (optional) if True, return lists with the unlensed and the
+                lensed map of each source instead of the last unlensed map
+                and the summed lensed map
+
+    RETURNS: unlensed and lensed maps, unlensed and lensed aperture masks,
+             and the total and aperture magnification of each source
+    """
+
+    # Compute the lensing potential gradients and magnification map:
+    t = stagetimer.clock()
+    dx, dy, dmu = deflect(x, y, nlens, parameters)
+    t = stagetimer.lap('raytrace', t)
+    nparlens = 5
+
     # hack to get the right index from the pzero vector
     interindx = nparlens * nlens
 
@@ -260,6 +558,8 @@ def sbmap(x, y, nlens, nsource, parameters, model_types):
     e_image = N.zeros(x.shape)
     amp1 = []
     amp2 = []
+    g_images = []
+    g_lensimages = []
     for i in N.arange(nsource):
 
         i6 = i * 6
@@ -271,38 +571,44 @@ def sbmap(x, y, nlens, nsource, parameters, model_types):
             gpar.append(parameters[i6 + interindx + ip])
         gpar = N.asarray(gpar)
 
-        # compute the peak flux of the unlensed gaussian
+        # compute the peak flux of the unlensed gaussian, averaged over the
+        # sub-pixels when refining so that the flux is normalized on the same
+        # grid as the refined lensed pixels
         model_type = model_types[i]
-        if model_type == 'gaussian':
-            g_image = gauss_2d(x, y, gpar)
-        if model_type == 'cylinder':
-            g_image = ellipse_2d(x, y, gpar)
+        if nsub > 1:
+            g_image = subpixelmean(x, y, gpar, model_type, nsigma, nsub)
+        else:
+            g_image = render(x, y, gpar, model_type, nsigma)
         totalflux = g_image.sum()
         if totalflux == 0:
             totalflux = 1.
         normflux = parameters[i6 + interindx] / totalflux
         gpar[0] *= normflux * 1e-3
 
-        # re-evaluate unlensed image with normalized flux
-        if model_type == 'gaussian':
-            g_image = gauss_2d(x, y, gpar)
-        if model_type == 'cylinder':
-            g_image = ellipse_2d(x, y, gpar)
+        # rescale unlensed image to the normalized flux
+        g_image *= normflux * 1e-3
 
         if nlens > 0:
             # Evaluate lensed Gaussian image:
-            if model_type == 'gaussian':
-                tmplens = gauss_2d(dx, dy, gpar)
-            if model_type == 'cylinder':
-                tmplens = ellipse_2d(dx, dy, gpar)
+            tmplens = render(dx, dy, gpar, model_type, nsigma)
+            if nsub > 1:
+                # Supersample pixels near critical curves or steep edges:
+                indx = refineindx(tmplens, dx, dy, gpar, dmu, muthresh, \
+                        gradthresh, sizethresh)
+                if indx.size > 0:
+                    sx, sy = subpixels(x, y, indx, nsub)
+                    t = stagetimer.lap('render', t)
+                    sdx, sdy, smu = deflect(sx, sy, nlens, parameters)
+                    t = stagetimer.lap('raytrace', t)
+                    sublens = render(sdx, sdy, gpar, model_type, nsigma)
+                    tmplens.flat[indx] = sublens.mean(axis=1)
             g_lensimage += tmplens
         else:
             # Use the unlensed (but normalized) Gaussian image
-            if model_type == 'gaussian':
-                tmplens = gauss_2d(x, y, gpar)
-            if model_type == 'cylinder':
-                tmplens = ellipse_2d(x, y, gpar)
+            tmplens = g_image.copy()
             g_lensimage += tmplens
+        g_images.append(g_image)
+        g_lensimages.append(tmplens)
 
         if nlens > 0:
             # Set elliptical source parameters and pack them into an array:
@@ -311,9 +617,9 @@ def sbmap(x, y, nlens, nsource, parameters, model_types):
             epar[1] *= 2.5
 
             # Evaluate lensed and unlensed elliptical masks:
-            lensellipse = ellipse_2d(dx, dy, epar)
+            lensellipse = render(dx, dy, epar, 'cylinder', nsigma)
             e_lensimage += lensellipse
-            ellipse = ellipse_2d(x, y, epar)
+            ellipse = render(x, y, epar, 'cylinder', nsigma)
             e_image += ellipse
 
             # Evaluate amplification for each source
@@ -337,5 +643,108 @@ def sbmap(x, y, nlens, nsource, parameters, model_types):
                 amp_mask = 1e2
             amp1.extend([amp_tot])
             amp2.extend([amp_mask])
+    stagetimer.lap('render', t)
 
+    if separate:
+        return g_images, g_lensimages, e_image, e_lensimage, amp1, amp2
     return g_image, g_lensimage, e_image, e_lensimage, amp1, amp2
+
+def sbmapgrad(x, y, nlens, nsource, parameters, model_types, gmap, \
+        nsigma=None, step=1e-5):
+    """
+    NAME: sbmapgrad
+
+    PURPOSE: Adjoint of sbmap: turn the gradient of a function with respect
+             to the lensed map into its gradient with respect to the lens
+             and source parameters
+
+    USAGE: grad = sbmapgrad(x, y, nlens, nsource, parameters, model_types,
+                            gmap)
+
+    ARGUMENTS:
+      x, y, nlens, nsource, parameters, model_types, nsigma: as for sbmap
+      gmap: derivative of the function with respect to each pixel of the
+            lensed map returned by sbmap (with nsub = 1)
+      step: (optional) relative step for the central differences of the
+            SIE deflections with respect to the lens parameters
+
+    RETURNS: derivative of the function with respect to each parameter
+
+    NOTES: The source terms, including the flux normalization over the
+           unlensed map, are analytic.  The deflection derivatives are
+           central differences of sie_grad, which only ray-trace the map
+           again and need no further FFTs.  Only Gaussian sources are
+           differentiable.
+    """
+    grad = N.zeros(len(parameters))
+    nparlens = 5
+    interindx = nparlens * nlens
+    dx, dy, dmu = deflect(x, y, nlens, parameters)
+
+    # coordinates at which the lensed map evaluates the sources; without a
+    # lens, sbmap returns the unlensed map
+    if nlens > 0:
+        tx, ty = dx, dy
+    else:
+        tx, ty = x, y
+
+    # derivatives of the deflections with respect to each lens parameter
+    ddx = []
+    ddy = []
+    for i in range(nlens):
+        lpar = N.asarray(parameters[i * nparlens:(i + 1) * nparlens], \
+                dtype=float)
+        for ip in range(nparlens):
+            h = step * max(N.abs(lpar[ip]), 1.)
+            lparhi = lpar.copy()
+            lparhi[ip] += h
+            lparlo = lpar.copy()
+            lparlo[ip] -= h
+            xghi, yghi, muhi = sie_grad(x, y, lparhi)
+            xglo, yglo, mulo = sie_grad(x, y, lparlo)
+            ddx.append((xghi - xglo) / (2 * h))
+            ddy.append((yghi - yglo) / (2 * h))
+
+    for i in range(nsource):
+        if model_types[i] != 'gaussian':
+            raise ValueError('sbmapgrad only supports gaussian sources')
+
+        i6 = interindx + i * 6
+        gpar = N.array(parameters[i6:i6 + 6], dtype=float)
+        flux = gpar[0]
+        gpar[0] = 1.
+
+        # unit-amplitude unlensed and lensed maps, limited to the pixels
+        # that render() evaluates
+        e_image, de_image, dedx, dedy = gauss_2d_grad(x, y, gpar)
+        e_lens, de_lens, delensdx, delensdy = gauss_2d_grad(tx, ty, gpar)
+        if nsigma is not None:
+            inside = N.zeros(x.shape)
+            inside.flat[footprint(x, y, gpar, nsigma)] = 1.
+            e_image *= inside
+            de_image *= inside
+            inside = N.zeros(x.shape)
+            inside.flat[footprint(tx, ty, gpar, nsigma)] = 1.
+            e_lens *= inside
+            de_lens *= inside
+            delensdx *= inside
+            delensdy *= inside
+
+        # lensed map = 1e-3 flux e_lens / sum(e_image)
+        total = e_image.sum()
+        if total == 0:
+            continue
+        scale = 1e-3 / total
+        gsum = (gmap * e_lens).sum()
+        grad[i6] = scale * gsum
+        for ip in range(1, 6):
+            grad[i6 + ip] = flux * scale * ((gmap * de_lens[ip]).sum() - \
+                    gsum * de_image[ip].sum() / total)
+
+        # the lens parameters move the traced coordinates
+        gx = flux * scale * gmap * delensdx
+        gy = flux * scale * gmap * delensdy
+        for ip in range(interindx):
+            grad[ip] += (gx * ddx[ip]).sum() + (gy * ddy[ip]).sum()
+
+    return grad
@@ -0,0 +1,426 @@
+"""
+Utilities for starting, running and monitoring the emcee sampling done by
+uvmcmcfit.
+"""
+
+import os
+import json
+import time
+import hashlib
+import resource
+import threading
+import BaseHTTPServer
+import numpy
+import emcee
+from emcee.ensemble import _function_wrapper
+
+
+# minimise fn with the Nelder-Mead downhill simplex, starting from p0 with
+# initial steps of size step along each axis.  It stops once the function
+# values of the simplex agree to ftol and its vertices agree to xtol times the
+# initial steps; function values alone can agree on a large simplex whose
+# vertices straddle the minimum.  Returns the best point and its function
+# value.
+def neldermead(fn, p0, step, maxiter=1000, ftol=1e-4, xtol=1e-3):
+
+    ndim = p0.size
+    simplex = numpy.zeros((ndim + 1, ndim))
+    simplex[:] = p0
+    for j in range(ndim):
+        simplex[j + 1, j] += step[j]
+    fsimplex = numpy.array([fn(p) for p in simplex])
+
+    for iteration in range(maxiter):
+        order = numpy.argsort(fsimplex)
+        simplex = simplex[order]
+        fsimplex = fsimplex[order]
+        size = numpy.abs((simplex[1:] - simplex[0]) / step).max()
+        if numpy.abs(fsimplex[-1] - fsimplex[0]) < ftol and size < xtol:
+            break
+
+        # reflect the worst point through the centroid of the others
+        centroid = simplex[:-1].mean(axis=0)
+        reflect = 2 * centroid - simplex[-1]
+        freflect = fn(reflect)
+        if freflect < fsimplex[0]:
+            expand = 3 * centroid - 2 * simplex[-1]
+            fexpand = fn(expand)
+            if fexpand < freflect:
+                simplex[-1], fsimplex[-1] = expand, fexpand
+            else:
+                simplex[-1], fsimplex[-1] = reflect, freflect
+        elif freflect < fsimplex[-2]:
+            simplex[-1], fsimplex[-1] = reflect, freflect
+        else:
+            contract = 0.5 * (centroid + simplex[-1])
+            fcontract = fn(contract)
+            if fcontract < fsimplex[-1]:
+                simplex[-1], fsimplex[-1] = contract, fcontract
+            else:
+                # shrink everything towards the best point
+                simplex[1:] = 0.5 * (simplex[0] + simplex[1:])
+                fsimplex[1:] = [fn(p) for p in simplex[1:]]
+
+    best = numpy.argmin(fsimplex)
+    return simplex[best], fsimplex[best]
+
+# maximise lnprob from one starting position.  Takes a single tuple so that
+# it can be handed to pool.map.
+def optimize(args):
+
+    lnprobfn, p0, step, lnprobargs, maxiter = args
+
+    def neglnprob(p):
+        probln = lnprobfn(p, *lnprobargs)[0]
+        if probln * 0 != 0:
+            return numpy.inf
+        return -probln
+
+    pbest, fbest = neldermead(neglnprob, p0, step, maxiter=maxiter)
+    return pbest, -fbest
+
+# group optimised positions into modes.  Positions are compared in units of
+# scale, and each joins the first (best) mode whose best member lies within
+# tol.  Returns the modes, best first, as lists of indices into points.
+def clustermodes(points, lnp, scale, tol=0.1):
+
+    modes = []
+    for i in numpy.argsort(lnp)[::-1]:
+        for mode in modes:
+            offset = (points[i] - points[mode[0]]) / scale
+            if numpy.sqrt((offset ** 2).mean()) < tol:
+                mode.append(i)
+                break
+        else:
+            modes.append([i])
+    return modes
+
+# nwalkers positions in a small Gaussian ball of width scale around center,
+# reflected back inside the bounds p_l and p_u
+def ball(center, scale, nwalkers, p_l, p_u):
+
+    pzero = center + scale * numpy.random.normal(size=(nwalkers, center.size))
+    for j in range(nwalkers):
+        exceed = pzero[j] >= p_u
+        pzero[j, exceed] = 2 * p_u[exceed] - pzero[j, exceed]
+        exceed = pzero[j] <= p_l
+        pzero[j, exceed] = 2 * p_l[exceed] - pzero[j, exceed]
+    return pzero
+
+# True once the best value of a history of (median) lnprob values has risen by
+# less than tol over the last window entries
+def plateau(history, window, tol):
+
+    if len(history) <= window:
+        return False
+    before = numpy.max(history[:-window])
+    return numpy.max(history[-window:]) - before < tol
+
+# integrated autocorrelation time of each parameter of an emcee chain with
+# shape (nwalkers, nsteps, ndim).  The autocorrelation function of every
+# walker is computed with an FFT and averaged over the walkers, and the sum is
+# truncated at the first lag m >= c * tau(m) (Sokal's automatic window).
+def autocorrtime(chain, c=5.):
+
+    nwalkers, nsteps, ndim = chain.shape
+    nfft = 2 ** int(numpy.ceil(numpy.log2(2 * nsteps)))
+    tau = numpy.zeros(ndim)
+    for j in range(ndim):
+        x = chain[:, :, j] - chain[:, :, j].mean(axis=1)[:, numpy.newaxis]
+        fx = numpy.fft.rfft(x, n=nfft, axis=1)
+        acf = numpy.fft.irfft(fx * fx.conjugate(), n=nfft, axis=1)
+        acf = acf[:, :nsteps].mean(axis=0)
+        if acf[0] <= 0:
+            # a parameter that never moved
+            tau[j] = numpy.inf
+            continue
+        taus = 2 * numpy.cumsum(acf / acf[0]) - 1
+        window = numpy.arange(nsteps) >= c * taus
+        if window.any():
+            tau[j] = taus[numpy.argmax(window)]
+        else:
+            tau[j] = taus[-1]
+    return tau
+
+# ln-likelihood for emcee's PTSampler, which expects a single number where
+# lnprob also returns its blob
+def lnlikeonly(p, lnprobfn, *lnprobargs):
+    return lnprobfn(p, *lnprobargs)[0]
+
+# flat prior inside the constraints p_l and p_u, so that PTSampler skips the
+# likelihood outside them
+def boxprior(p, p_l, p_u):
+    if (p < p_l).any() or (p > p_u).any():
+        return -numpy.inf
+    return 0.
+
+# split the walkers into stuck ones, with an acceptance fraction below minacc
+# or an lnprob more than dlnprob below the median, and healthy ones, which are
+# neither and have at least the median lnprob
+def stuckwalkers(lnprob, acceptance, minacc, dlnprob):
+
+    median = numpy.median(lnprob[numpy.isfinite(lnprob)])
+    stuck = (acceptance < minacc) | ~(lnprob > median - dlnprob)
+    healthy = ~stuck & (lnprob >= median)
+    return numpy.flatnonzero(stuck), numpy.flatnonzero(healthy)
+
+
+class DelayedSampler(emcee.EnsembleSampler):
+    """
+    An emcee EnsembleSampler with delayed acceptance.  Each stretch-move
+    proposal is first screened with the cheap surrogatefn, and lnpostfn is
+    only evaluated for proposals that pass.  The second stage accepts with
+    probability min(1, exp(dlnpost - dlnsurrogate)), so the chain still
+    samples the exact posterior of lnpostfn.
+
+    surrogatefn is called as surrogatefn(p, *surrogateargs) and returns
+    (lnprob, blob) like lnpostfn.  nscreened and nfull count the surrogate
+    and full evaluations of proposals.
+    """
+
+    def __init__(self, nwalkers, dim, lnpostfn, surrogatefn, surrogateargs, \
+            **kwargs):
+        emcee.EnsembleSampler.__init__(self, nwalkers, dim, lnpostfn, \
+                **kwargs)
+        self.surrogatefn = _function_wrapper(surrogatefn, surrogateargs, {})
+        self.nscreened = 0
+        self.nfull = 0
+
+        # surrogate lnprob at the current walker positions.  It is rebuilt
+        # every half-step from the positions of the two halves, so it never
+        # holds more than nwalkers entries.
+        self._lnsurrogate = {}
+
+    def reset(self):
+        emcee.EnsembleSampler.reset(self)
+        self.nscreened = 0
+        self.nfull = 0
+        self._lnsurrogate = {}
+
+    def _get_lnsurrogate(self, pos):
+        if self.pool is not None:
+            M = self.pool.map
+        else:
+            M = map
+        results = M(self.surrogatefn, [pos[i] for i in range(len(pos))])
+        return numpy.array([float(result[0]) for result in results])
+
+    def _propose_stretch(self, p0, p1, lnprob0):
+        s = numpy.atleast_2d(p0)
+        Ns = len(s)
+        c = numpy.atleast_2d(p1)
+        Nc = len(c)
+
+        # surrogate at the current positions, computed when first needed
+        keys = [pos.tostring() for pos in s]
+        missing = [i for i in range(Ns) if keys[i] not in self._lnsurrogate]
+        if len(missing) > 0:
+            lnsmissing = self._get_lnsurrogate(s[missing])
+            for i, lns in zip(missing, lnsmissing):
+                self._lnsurrogate[keys[i]] = lns
+        lns0 = numpy.array([self._lnsurrogate[key] for key in keys])
+
+        # stretch-move proposals, as in emcee
+        zz = ((self.a - 1.) * self._random.rand(Ns) + 1) ** 2. / self.a
+        rint = self._random.randint(Nc, size=(Ns,))
+        q = c[rint] - zz[:, numpy.newaxis] * (c[rint] - s)
+
+        # first stage: screen with the surrogate.  Walkers at zero posterior
+        # or zero surrogate skip the screening.
+        lnsq = self._get_lnsurrogate(q)
+        self.nscreened += Ns
+        screen = numpy.isfinite(lns0) & numpy.isfinite(lnprob0)
+        dlns = numpy.zeros(Ns)
+        dlns[screen] = lnsq[screen] - lns0[screen]
+        lnpdiff = (self.dim - 1.) * numpy.log(zz) + dlns
+        passed = ~screen | (lnpdiff > numpy.log(self._random.rand(Ns)))
+
+        # second stage: full lnprob for the proposals that passed
+        newlnprob = numpy.zeros(Ns) - numpy.inf
+        blob = None
+        accept = numpy.zeros(Ns, dtype=bool)
+        indx = numpy.flatnonzero(passed)
+        if indx.size > 0:
+            newlnprob[indx], passblob = self._get_lnprob(q[indx])
+            self.nfull += indx.size
+            if passblob is not None:
+                blob = [None] * Ns
+                for i, b in zip(indx, passblob):
+                    blob[i] = b
+            lnpdiff = newlnprob[indx] - lnprob0[indx] - dlns[indx]
+            unscreened = ~screen[indx]
+            lnpdiff[unscreened] += (self.dim - 1.) * \
+                    numpy.log(zz[indx][unscreened])
+            accept[indx] = lnpdiff > numpy.log(self._random.rand(indx.size))
+
+        # keep the surrogate of the positions the walkers will hold
+        lnsurrogate = {}
+        for i in range(Ns):
+            if accept[i]:
+                lnsurrogate[q[i].tostring()] = lnsq[i]
+            else:
+                lnsurrogate[keys[i]] = lns0[i]
+        for pos in c:
+            key = pos.tostring()
+            if key in self._lnsurrogate:
+                lnsurrogate[key] = self._lnsurrogate[key]
+        assert len(lnsurrogate) <= Ns + Nc
+        self._lnsurrogate = lnsurrogate
+
+        return q, newlnprob, accept, blob
+
+
+# keep in sample a uniform random sample of at most size of the items offered
+# so far; nseen is the number offered before item
+def reservoir(sample, item, nseen, size, random):
+    if len(sample) < size:
+        sample.append(item)
+        return
+    j = random.randint(nseen + 1)
+    if j < size:
+        sample[j] = item
+
+class CallRecorder(object):
+    """
+    Keeps a uniform random sample of at most size of the positions at which
+    an emcee sampler evaluates its lnpostfn, with their lnprob values, drawn
+    with the numpy RandomState random.  Every evaluation is offered, so
+    rejected proposals are recorded as well as accepted ones.  The sampler's
+    _get_lnprob is wrapped in the main process, where the values come back
+    from the workers.
+
+    sample holds (lnprob, position) pairs, and ncalls counts the evaluations
+    offered.
+    """
+
+    def __init__(self, sampler, size, random):
+        self.sampler = sampler
+        self.size = size
+        self.random = random
+        self.sample = []
+        self.ncalls = 0
+        self._get_lnprob = sampler._get_lnprob
+        sampler._get_lnprob = self.get_lnprob
+
+    def get_lnprob(self, pos=None):
+        lnprob, blob = self._get_lnprob(pos)
+        if pos is None:
+            pos = self.sampler.pos
+        for i in range(len(lnprob)):
+            reservoir(self.sample, (lnprob[i], numpy.array(pos[i])), \
+                    self.ncalls, self.size, self.random)
+            self.ncalls += 1
+        return lnprob, blob
+
+
+# identity of the data and settings in the lnprob arguments: a SHA-1 digest of
+# every array they contain, and of the text of everything else
+def datahash(args, digest=None):
+    if digest is None:
+        digest = hashlib.sha1()
+    if isinstance(args, numpy.ndarray):
+        digest.update(str(args.dtype) + str(args.shape))
+        digest.update(numpy.ascontiguousarray(args).tostring())
+    elif isinstance(args, (list, tuple)):
+        for arg in args:
+            datahash(arg, digest)
+    elif isinstance(args, dict):
+        for key in sorted(args):
+            digest.update(repr(key))
+            datahash(args[key], digest)
+    else:
+        digest.update(repr(args))
+    return digest.hexdigest()
+
+# evaluate lnprobfn again at each of the parameter vectors in points, one
+# after another.  Returns the lnprob values and the seconds per call.
+def replay(lnprobfn, lnprobargs, points):
+    lnp = numpy.zeros(len(points))
+    start = time.time()
+    for i in range(len(points)):
+        lnp[i] = lnprobfn(points[i], *lnprobargs)[0]
+    return lnp, (time.time() - start) / max(len(points), 1)
+
+# peak resident memory in MB of the process pid (by default this one), from
+# /proc where it exists
+def peakrss(pid=None, field='VmHWM:'):
+    if pid is None:
+        pid = os.getpid()
+    try:
+        for line in open('/proc/' + str(pid) + '/status'):
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    if pid == os.getpid():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return None
+
+# resident memory in MB of the process pid now, or its peak so far where /proc
+# does not exist
+def rss(pid=None):
+    return peakrss(pid, field='VmRSS:')
+
+# process ids of the workers of a multiprocessing pool
+def workerpids(pool):
+    return [worker.pid for worker in getattr(pool, '_pool', [])]
+
+
+class ProgressMonitor(object):
+    """
+    A structured progress channel for a run.  update() records the status, a
+    dictionary of numbers and strings, and rewrites it as JSON to statusloc
+    at most every interval seconds.  The file is written to a temporary file
+    and renamed, so a reader never sees half of it.  If port is given, the
+    latest status is also served as JSON over HTTP on localhost:port.
+
+    The peak resident memory of the process, in MB, is added to every status.
+    """
+
+    def __init__(self, statusloc, interval=10., port=None):
+        self.statusloc = statusloc
+        self.interval = interval
+        self.status = {}
+        self._lastwrite = -numpy.inf
+        self.server = None
+        if port is not None:
+            self._serve(port)
+
+    def _serve(self, port):
+        monitor = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(monitor.status, sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # keep the requests out of the run's log
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def update(self, force=False, **status):
+        status['peakmemory'] = peakrss()
+        status['time'] = time.time()
+        self.status = status
+        if self.statusloc is None:
+            return
+        if force or status['time'] - self._lastwrite >= self.interval:
+            statusfile = open(self.statusloc + '.tmp', 'w')
+            json.dump(status, statusfile, indent=1, sort_keys=True)
+            statusfile.close()
+            os.rename(self.statusloc + '.tmp', self.statusloc)
+            self._lastwrite = status['time']
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Merge the posteriors of independent uvmcmcfit ensembles into one
+posteriorpdf.hdf5 for the plotting scripts.
+
+USAGE
+
+ Run K ensembles as a job array, each with UVMCMCFIT_CHAIN set to its index
+ (e.g. UVMCMCFIT_CHAIN=$SLURM_ARRAY_TASK_ID python $PYSRC/uvmcmcfit.py), so
+ that each uses its own random seed (config.Seed + index) and writes
+ posteriorpdf.chain<index>.hdf5.  Then run
+
+ python $PYSRC/mergepdf.py [burnin [nwalkers]]
+
+ to drop the first burnin fraction (default 0.5) of every chain, print the
+ cross-chain R-hat of every column, and write posteriorpdf.hdf5.  The number
+ of walkers is read from the chains; give it for chains written by older
+ versions of uvmcmcfit, which do not record it.  A column
+ whose R-hat is above 1.1, or is not finite, is reported as unconverged.
+"""
+
+import glob
+import sys
+import numpy
+import modifypdf
+
+
+pdflocs = sorted(glob.glob('posteriorpdf.chain*.hdf5'))
+if len(pdflocs) < 2:
+    sys.exit('Need at least two posteriorpdf.chain*.hdf5 files to merge')
+if len(sys.argv) > 1:
+    burnin = float(sys.argv[1])
+else:
+    burnin = 0.5
+if len(sys.argv) > 2:
+    nwalkers = int(sys.argv[2])
+else:
+    nwalkers = None
+
+print 'Merging ' + str(pdflocs)
+rhats = modifypdf.merge(pdflocs, 'posteriorpdf.hdf5', nwalkers=nwalkers, \
+        burnin=burnin)
+finite = [value for value in rhats.values() if numpy.isfinite(value)]
+if len(finite) > 0:
+    print 'Largest finite R-hat: ' + str(max(finite))
+nonfinite = [name for name in sorted(rhats) if numpy.isnan(rhats[name])]
+if len(nonfinite) > 0:
+    print 'Warning: R-hat is nan (samples that are not finite) for ' + \
+            str(nonfinite)
+stuck = [name for name in sorted(rhats) if numpy.isinf(rhats[name])]
+if len(stuck) > 0:
+    print 'Warning: R-hat is inf (chains stuck at different values) for ' + \
+            str(stuck)
+unconverged = modifypdf.unconverged(rhats)
+if len(unconverged) > 0:
+    print 'Warning: R-hat above 1.1 or not finite, the chains have not ' + \
+            'converged in ' + str(unconverged)
@@ -9,6 +9,8 @@ functions.
 """
 
 from astropy.table import Table
+from astropy.table import vstack
+from astropy.io.misc import hdf5
 import numpy
 
 
@@ -69,3 +71,73 @@ def prune(PDFdata, scaler=5.0):
     # return the trimmed list
     #PDFdata.write(newpdfloc, format='ascii')
     return PDFdata
+
+def rhat(chains):
+
+    # Gelman-Rubin potential scale reduction factor of one parameter, given
+    # equal-length samples of it from several independent chains
+    chains = numpy.asarray(chains, dtype=float)
+    nchain, nsample = chains.shape
+
+    # a column that never changes, such as a fixed parameter, agrees, and
+    # chains stuck at different values do not; compared exactly, as the
+    # variances of a constant column are rounding errors
+    if (chains == chains.flat[0]).all():
+        return 1.
+    if not numpy.isfinite(chains).all():
+        return numpy.nan
+    if (chains == chains[:, :1]).all():
+        return numpy.inf
+    within = chains.var(axis=1, ddof=1).mean()
+    between = nsample * chains.mean(axis=1).var(ddof=1)
+    pooled = (nsample - 1.) / nsample * within + between / nsample
+    return numpy.sqrt(pooled / within)
+
+def unconverged(rhats, threshold=1.1):
+
+    # the columns whose R-hat is above threshold, or is nan because their
+    # samples are not all finite
+    return [name for name in sorted(rhats) if not rhats[name] <= threshold]
+
+def merge(pdflocs, newpdfloc, nwalkers=None, burnin=0.5):
+
+    # the number of walkers of every chain, as uvmcmcfit records it, unless
+    # it is given
+    PDFs = [hdf5.read_table_hdf5(pdfloc) for pdfloc in pdflocs]
+    if nwalkers is None:
+        recorded = set([PDF.meta.get('nwalkers') for PDF in PDFs])
+        if len(recorded) != 1 or None in recorded:
+            raise ValueError('The chains do not all record the same ' + \
+                    'number of walkers; pass nwalkers to merge')
+        nwalkers = recorded.pop()
+
+    # drop the first burnin fraction of the iterations of every chain, and
+    # keep the same number of final iterations from each
+    niters = [len(PDFdata) / nwalkers for PDFdata in PDFs]
+    nkeep = min([niter - int(burnin * niter) for niter in niters])
+    PDFs = [PDFdata[len(PDFdata) - nkeep * nwalkers:] for PDFdata in PDFs]
+
+    # cross-chain convergence of every column
+    rhats = {}
+    for name in PDFs[0].colnames:
+        rhats[name] = rhat([PDFdata[name] for PDFdata in PDFs])
+        print name + ': R-hat = ' + str(rhats[name])
+
+    # interleave the chains iteration by iteration, so that the merged file
+    # reads like one ensemble of len(pdflocs) * nwalkers walkers
+    order = numpy.arange(len(PDFs) * nkeep * nwalkers)
+    order = order.reshape(len(PDFs), nkeep, nwalkers)
+    order = order.transpose(1, 0, 2).flatten()
+    PDFdata = vstack(PDFs)[order]
+
+    # the stage timers written with TimeStages add up over the chains
+    for key in PDFdata.meta:
+        if key.startswith('timing_') and key != 'timing_bins':
+            PDFdata.meta[key] = sum([PDF.meta[key] for PDF in PDFs \
+                    if key in PDF.meta])
+        elif key == 'timing_bins':
+            PDFdata.meta[key] = PDFs[0].meta[key]
+    PDFdata.meta['nwalkers'] = len(PDFs) * nwalkers
+    hdf5.write_table_hdf5(PDFdata, newpdfloc, path='/posteriorpdf', \
+            overwrite=True, compression=True)
+    return rhats
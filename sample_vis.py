@@ -21,6 +21,7 @@ Ported from an IDL routine of the same name from Katherine Rosenfeld
 #import ModGrid
 import numpy
 import grid
+import stagetimer
 #cimport numpy
 #import pdb
 
@@ -416,6 +417,67 @@ def ModGrid1(vv, uu, v0, u0, Grd, gcf, ngcf, nyd, width):
     return Intp
 
 
+# The gridding correction and convolution functions only depend on the size of
+# the padded grid, so each is computed once per size and then reused.
+gridtables = {}
+
+
+def corrtable(nyd, nxd):
+    key = ('corr', nyd, nxd)
+    if key not in gridtables:
+        ycorr, xcorr = grid.ModCorr(nyd, nxd)
+        gridtables[key] = numpy.outer(ycorr, xcorr)
+    return gridtables[key]
+
+
+def gcftable(ngcf, width, alpha):
+    key = ('gcf', ngcf, width, alpha)
+    if key not in gridtables:
+        gridtables[key] = grid.gcffun(ngcf, width, alpha)
+    return gridtables[key]
+
+
+def binimage(model, nbin):
+    """
+    Integrate a model image down to a coarser cell size by summing nbin x nbin
+    blocks of pixels.  The image dimensions must be multiples of nbin.
+    """
+    ny, nx = model.shape
+    binned = model.reshape(ny / nbin, nbin, nx / nbin, nbin)
+    return binned.sum(axis=3).sum(axis=1)
+
+
+def binheader(modelheader, nbin):
+    """
+    Return a copy of modelheader describing the image produced by binimage.
+    """
+    header = modelheader.copy()
+    for axis in ['1', '2']:
+        header['NAXIS' + axis] = modelheader['NAXIS' + axis] / nbin
+        header['CDELT' + axis] = modelheader['CDELT' + axis] * nbin
+        crpix = modelheader['CRPIX' + axis]
+        header['CRPIX' + axis] = (crpix - 0.5) / nbin + 0.5
+    return header
+
+
+# bytes of the arrays that uvmodel holds at once for a model map with this
+# header, as measured with numpy 1.16 (the rise in peak resident memory over a
+# call, fitted over canvases of 64 to 2048 cells and 1e5 to 1e6 visibilities).
+# The padded FFT canvas peaks at 64 bytes a cell: the real zero-padded copies
+# and the complex image, its rolled and corrected copies and its FFT are not
+# all alive at once.  The gridding correction cached for the canvas adds 8
+# bytes a cell.  ModGrid1 peaks at 515 bytes a visibility, mostly its two
+# rows of 6 kernel weights (96 bytes), 12 integer index arrays (96 bytes) and
+# 12 complex partial sums (192 bytes), with the fractional offsets, gathered
+# grid values and the returned visibilities.
+def uvmodelbytes(modelheader, nvis):
+    nxd = 2 ** numpy.ceil(numpy.log2(2. * modelheader['NAXIS1']))
+    nyd = 2 ** numpy.ceil(numpy.log2(2. * modelheader['NAXIS2']))
+    canvas = nxd * nyd * (64 + 8)
+    degrid = nvis * 520
+    return int(canvas), int(degrid)
+
+
 def uvmodel(model, modelheader, u, v, pcd):
 
     #model = ''
@@ -434,6 +496,7 @@ def uvmodel(model, modelheader, u, v, pcd):
     alpha = 1.	 # - hard coded
     width = 6	 # - hard coded
     maxgcf = 2048
+    t = stagetimer.clock()
 
     # - griding info: read in data visibilities
     #miriad = pyfits.getdata(visfile)
@@ -496,6 +559,7 @@ def uvmodel(model, modelheader, u, v, pcd):
     image = areal + 1j * aimag
     image = numpy.roll(image, ny/2, axis=0)
     image = numpy.roll(image, nx/2, axis=1)
+    t = stagetimer.lap('pad', t)
 
     #mu_grid, dump = numpy.meshgrid(mu, numpy.zeros(nxd) + 1)
     #mu_grid_shifty = numpy.roll(mu_grid, -1 * u0int, axis=0)
@@ -524,9 +588,9 @@ def uvmodel(model, modelheader, u, v, pcd):
         #print 'ModCorr (grid.for)'
         #import time
         #start = time.time()
-        ycorr, xcorr = grid.ModCorr(nyd, nxd)
-        mcorr = numpy.outer(ycorr, xcorr)
+        mcorr = corrtable(nyd, nxd)
         image = image / mcorr
+        t = stagetimer.lap('ModCorr', t)
         #time_modgrid = time.time()-start
         #print 'time to run ModCorr: ', time_modgrid, 'seconds'
 
@@ -536,12 +600,14 @@ def uvmodel(model, modelheader, u, v, pcd):
     #cdef numpy.ndarray mvis_imag
     mvis = numpy.fft.fft2(image)
     mvis = numpy.conjugate(mvis)
+    t = stagetimer.lap('fft2', t)
 
     # - Follow ModGrid in model.for
     #print 'ModGrid (model.for)'
     #cdef numpy.ndarray gcf
     ngcf = width * ((maxgcf - 1) / width) + 1
-    gcf = grid.gcffun(ngcf, width, alpha)
+    gcf = gcftable(ngcf, width, alpha)
+    t = stagetimer.lap('gcffun', t)
 
     #cdef numpy.ndarray uu
     #cdef numpy.ndarray vv
@@ -575,6 +641,7 @@ def uvmodel(model, modelheader, u, v, pcd):
         mvis_opt[overmax] = 0.
         overmax = numpy.abs(uu) > umax
         mvis_opt[overmax] = 0.
+        t = stagetimer.lap('ModGrid1', t)
         #mvis_opt1 = numpy.zeros(nvis) + 1.j * numpy.zeros(nvis)
         #p = numpy.zeros(nvis)
         #q = numpy.zeros(nvis)
@@ -602,6 +669,7 @@ def uvmodel(model, modelheader, u, v, pcd):
         #        start = time.time()
         mvis_opt = grid.ModShift(ud, vd, raref1, decref1, raref2, \
                         decref2, 1, 1, mvis_opt)
+        stagetimer.lap('ModShift', t)
         #for i in numpy.arange(nvis):
         #    if (numpy.abs(uu[i]) > umax) or (numpy.abs(vv[i]) > vmax):
         #        mvis_opt[i] = 0.
@@ -685,3 +753,116 @@ def uvmodel(model, modelheader, u, v, pcd):
     #print numpy.abs(mvis_opt).min()
     #import pdb; pdb.set_trace()
     return mvis_opt
+
+
+def ModGrid1Adjoint(vv, uu, gIntp, gcf, ngcf, nyd, nxd, width):
+    """
+    Adjoint of ModGrid1, called with the same coordinates: spread the
+    gradients gIntp (d/dreal + 1j d/dimag) of a real function of the
+    interpolated visibilities back onto the gradient of the nyd x nxd grid.
+    Like ModGrid1, which wraps both axes at nyd, it only handles square
+    grids.
+    """
+    assert nxd == nyd, 'ModGrid1 only degrids square grids'
+    uuu = uu.copy()
+    vvv = vv.copy()
+    conjugate = (uuu < 0)
+    uuu[conjugate] = -1 * uuu[conjugate]
+    vvv[conjugate] = -1 * vvv[conjugate]
+    negv = (vvv < 0)
+    vvv[negv] = nyd - numpy.abs(vvv[negv])
+    checkhigh = vvv == nyd
+    vvv[checkhigh] = nyd - 1
+
+    # the same kernel weights as ModGrid1
+    nvis = vvv.size
+    wu = numpy.zeros([width, nvis])
+    wv = numpy.zeros([width, nvis])
+    step = (ngcf - 1) / width
+    rv = vvv - numpy.floor(vvv)
+    ru = uuu - numpy.floor(uuu)
+    uuu = numpy.floor(uuu).astype(int)
+    vvv = numpy.floor(vvv).astype(int)
+    p  = ngcf / 2 - numpy.around(step * rv)
+    q  = ngcf / 2 - numpy.around(step * ru)
+    for i in range(width):
+        wu[i, :] = gcf[q.astype(int) + step * (i - width / 2 + 1)]
+        wv[i, :] = gcf[p.astype(int) + step * (i - width / 2 + 1)]
+    w = wu.sum(axis = 0) * wv.sum(axis = 0)
+
+    # undo the final conjugation and normalization
+    gsum = gIntp / w
+    gsum[conjugate] = numpy.conjugate(gsum[conjugate])
+
+    # scatter onto the grid cells that were read, with wrap-around
+    indx = []
+    weight = []
+    for j in range(width):
+        vindx = (vvv + j - width / 2 + 1) % nyd
+        for i in range(width):
+            uindx = (uuu + i - width / 2 + 1) % nyd
+            indx.append(uindx * nxd + vindx)
+            weight.append(wu[i, :] * wv[j, :] * gsum)
+    indx = numpy.concatenate(indx)
+    weight = numpy.concatenate(weight)
+    greal = numpy.bincount(indx, weights=numpy.real(weight), \
+            minlength=nyd * nxd)
+    gimag = numpy.bincount(indx, weights=numpy.imag(weight), \
+            minlength=nyd * nxd)
+    return (greal + 1j * gimag).reshape(nyd, nxd)
+
+
+def uvmodeladjoint(gvis, modelheader, u, v, pcd):
+    """
+    Adjoint of uvmodel.  Given the gradient gvis (d/dreal + 1j d/dimag) of a
+    real function of the model visibilities uvmodel(model, modelheader, u, v,
+    pcd), return the gradient of that function with respect to each pixel of
+    model.  It costs one inverse FFT plus the gridding of the visibilities.
+    """
+    alpha = 1.
+    width = 6
+    maxgcf = 2048
+
+    # the same geometry as uvmodel
+    nx = modelheader['NAXIS1']
+    ny = modelheader['NAXIS2']
+    ln2 = numpy.log(2)
+    nxd = numpy.long(2 ** numpy.ceil(numpy.log(2. * nx) / ln2))
+    nyd = numpy.long(2 ** numpy.ceil(numpy.log(2. * ny) / ln2))
+    dx = modelheader['CDELT1'] * pi / 180
+    dy = modelheader['CDELT2'] * pi / 180
+    du = 1. / (dx * nxd)
+    dv = 1. / (dy * nyd)
+    umax = 0.5 * (nxd - 1 - width)
+    vmax = 0.5 * (nyd - 1 - width)
+    iref = nx / 2 + 1
+    jref = ny / 2 + 1
+    pcm = [modelheader['CRVAL1'], modelheader['CRVAL2']]
+    raref1 = dx * (modelheader['CRPIX1'] - iref)
+    decref1 = dy * (modelheader['CRPIX2'] - jref)
+    raref2 = (pcd[0] - pcm[0]) * \
+        numpy.cos(pcd[1] * pi / 180.) * pi / 180.
+    decref2 = (pcd[1] - pcm[1]) * pi / 180.
+    ucoeff, vcoeff, wcoeff = grid.coGeom(pcm, pcd)
+    ud = ucoeff[0] * u + ucoeff[1] * v
+    vd = vcoeff[0] * u + vcoeff[1] * v
+    uu = ud / du
+    vv = vd / dv
+
+    # phase shift, and the visibilities that uvmodel sets to zero
+    shift = grid.ModShift(ud, vd, raref1, decref1, raref2, decref2, 1, 1, \
+            numpy.ones(len(u)))
+    gIntp = numpy.conjugate(shift) * gvis
+    gIntp[numpy.abs(vv) > vmax] = 0.
+    gIntp[numpy.abs(uu) > umax] = 0.
+
+    # degridding, conjugated FFT, gridding correction, shift and padding
+    ngcf = width * ((maxgcf - 1) / width) + 1
+    gcf = gcftable(ngcf, width, alpha)
+    gmvis = ModGrid1Adjoint(uu, vv, gIntp, gcf, ngcf, nyd, nxd, width)
+    gimage = nxd * nyd * numpy.fft.ifft2(numpy.conjugate(gmvis))
+    gimage = numpy.real(gimage) / corrtable(nyd, nxd)
+    gimage = numpy.roll(gimage, -(ny / 2), axis=0)
+    gimage = numpy.roll(gimage, -(nx / 2), axis=1)
+    noff = nxd - nx
+    return gimage[noff:, noff:]
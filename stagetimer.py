@@ -0,0 +1,106 @@
+"""
+Per-stage timers and counters for the likelihood calculation.
+
+The stages of lnprob (bound checks, ray tracing, rendering, the FFT, the
+gridding and so on) bracket their work with clock() and lap():
+
+    t = stagetimer.clock()
+    ...
+    t = stagetimer.lap('fft2', t)
+
+When timing is switched off, which is the default, clock() returns None and
+lap() returns straight away, so the instrumentation costs a function call
+per stage.  When it is on, every lap adds to the number of calls, the total
+time and a histogram of the times of its stage.  Each process keeps its own
+totals; snapshot() tags them with the process id so that the sampler can
+combine the snapshots returned by its workers with collect() and total().
+Stages timed while a prefix is set, such as 'surrogate_' for the surrogate
+of delayed acceptance, are kept apart from the others.
+"""
+
+import os
+import time
+import math
+import numpy
+
+enabled = False
+
+# edges of the histogram bins of the lap times, in seconds, 4 per decade
+histedges = 10 ** numpy.arange(-7, 2.01, 0.25)
+nbins = len(histedges) - 1
+
+# for each stage: the number of calls, the total time, then the histogram
+stats = {}
+
+# prefix added to the names of the stages timed now
+prefix = ''
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def setprefix(name=''):
+    global prefix
+    prefix = name
+
+# the start time of a stage, or None when timing is off
+def clock():
+    if not enabled:
+        return None
+    return time.time()
+
+# add the time since t0 to stage, and return the time now as the start of the
+# next stage
+def lap(stage, t0):
+    if t0 is None:
+        return None
+    now = time.time()
+    dt = now - t0
+    stage = prefix + stage
+    if stage not in stats:
+        stats[stage] = numpy.zeros(2 + nbins)
+    entry = stats[stage]
+    entry[0] += 1
+    entry[1] += dt
+    if dt > 0:
+        ibin = int(math.floor(4 * (math.log10(dt) + 7)))
+    else:
+        ibin = 0
+    entry[2 + min(max(ibin, 0), nbins - 1)] += 1
+    return now
+
+# a copy of the totals of this process, tagged with its process id
+def snapshot():
+    return os.getpid(), dict([(stage, stats[stage].copy()) \
+            for stage in stats])
+
+# keep the latest snapshot of each process in latest, a dictionary keyed by
+# process id.  The totals only grow, so the latest is the one with the most
+# calls, whatever order the snapshots arrive in.
+def collect(latest, snap):
+    pid, pidstats = snap
+    ncalls = sum([entry[0] for entry in pidstats.values()])
+    if pid not in latest or ncalls > latest[pid][0]:
+        latest[pid] = (ncalls, pidstats)
+
+# the totals of every stage, summed over the processes in latest
+def total(latest):
+    totals = {}
+    for ncalls, pidstats in latest.values():
+        for stage in pidstats:
+            if stage in totals:
+                totals[stage] = totals[stage] + pidstats[stage]
+            else:
+                totals[stage] = pidstats[stage].copy()
+    return totals
+
+# the totals as a dictionary that can be written as JSON
+def summary(totals):
+    result = {}
+    for stage in totals:
+        entry = totals[stage]
+        result[stage] = {'calls': int(entry[0]), 'seconds': entry[1], \
+                'mean': entry[1] / max(entry[0], 1), \
+                'histogram': [int(n) for n in entry[2:]]}
+    return result
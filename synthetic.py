@@ -0,0 +1,159 @@
+"""
+Synthetic visibility data sets for the uvmcmcfit benchmarks (uvbenchmark.py
+and uvscaling.py).
+
+A setup is a dictionary with the telescope ('ALMA' or 'PdBI'), the number of
+visibilities nvis (counting every spectral window, channel and
+polarization), nchan, npol and nspw, the RadialExtent (extent) and
+Oversample of the single model region, and its numbers of lenses (nlens) and
+Gaussian sources (nsource).  writefit writes, for a setup, everything
+uvmcmcfit needs to run in a directory: a uvfits file of noise in the layout
+that uvutil.uvload and uvutil.visload read, an image of the field and a
+config.py.
+"""
+
+import os
+import numpy
+from astropy.io import fits
+
+# observing frequency in Hz, image cell size in arcsec and longest baseline
+# in wavelengths of each telescope
+frequency = {'ALMA': 340e9, 'PdBI': 240e9}
+cellsize = {'ALMA': 0.1, 'PdBI': 0.25}
+uvrange = {'ALMA': 5e5, 'PdBI': 2e5}
+racentroid = 150.
+deccentroid = 2.
+
+
+# a uvfits file of nvis random baselines of noise, in the layout of the
+# telescope; the visibilities are nvis * nspw * nchan * npol
+def writeuvfits(uvfitsloc, setup, random):
+    telescope = setup['telescope']
+    nvis = setup['nvis'] / (setup['nspw'] * setup['nchan'] * setup['npol'])
+    nvis = max(nvis, 1)
+    freq = frequency[telescope]
+    uvdist = uvrange[telescope] * numpy.sqrt(random.uniform(size=nvis))
+    angle = random.uniform(0, 2 * numpy.pi, nvis)
+    uu = uvdist * numpy.cos(angle) / freq
+    vv = uvdist * numpy.sin(angle) / freq
+
+    if telescope == 'ALMA':
+        shape = (nvis, 1, 1, setup['nspw'], setup['nchan'], setup['npol'], 3)
+    else:
+        shape = (nvis, 1, 1, setup['nchan'], setup['npol'], 3)
+    data = numpy.zeros(shape, dtype=numpy.float32)
+    sigma = 1e-3
+    data[..., 0] = random.normal(0, sigma, shape[:-1])
+    data[..., 1] = random.normal(0, sigma, shape[:-1])
+    data[..., 2] = 1 / sigma ** 2
+
+    groups = fits.GroupData(data, bitpix=-32, \
+            parnames=['UU', 'VV', 'WW', 'BASELINE', 'DATE'], \
+            pardata=[uu, vv, numpy.zeros(nvis), \
+            numpy.zeros(nvis) + 258., numpy.zeros(nvis) + 2456000.5])
+    hdu = fits.GroupsHDU(groups)
+    header = hdu.header
+    header['TELESCOP'] = telescope
+    header['OBJECT'] = 'SYNTHETIC'
+    axes = ['COMPLEX', 'STOKES', 'FREQ']
+    if telescope == 'ALMA':
+        axes.append('IF')
+    axes.extend(['RA', 'DEC'])
+    for i in range(len(axes)):
+        header['CTYPE' + str(i + 2)] = axes[i]
+        header['CRVAL' + str(i + 2)] = 1.
+        header['CDELT' + str(i + 2)] = 1.
+        header['CRPIX' + str(i + 2)] = 1.
+    header['CRVAL4'] = freq
+    header['CDELT4'] = 15.625e6
+    header['CRVAL3'] = -5.
+    header['CDELT3'] = -1.
+    header['CRVAL' + str(len(axes))] = racentroid
+    header['CRVAL' + str(len(axes) + 1)] = deccentroid
+    header['OBSRA'] = racentroid
+    header['OBSDEC'] = deccentroid
+    hdus = [hdu]
+
+    if telescope == 'ALMA':
+        nspw = setup['nspw']
+        iffreq = numpy.arange(nspw) * 2e9
+        fq = fits.BinTableHDU.from_columns([ \
+                fits.Column(name='FRQSEL', format='1J', array=[1]), \
+                fits.Column(name='IF FREQ', format=str(nspw) + 'D', \
+                array=iffreq.reshape(1, nspw))])
+        fq.header['EXTNAME'] = 'AIPS FQ'
+        su = fits.BinTableHDU.from_columns([ \
+                fits.Column(name='ID. NO.', format='1J', array=[1]), \
+                fits.Column(name='RAEPO', format='1D', array=[racentroid]), \
+                fits.Column(name='DECEPO', format='1D', \
+                array=[deccentroid])])
+        su.header['EXTNAME'] = 'AIPS SU'
+        hdus.extend([fq, su])
+    fits.HDUList(hdus).writeto(uvfitsloc, clobber=True)
+
+# an image of the field, which sets the cell size of the model maps
+def writeimage(imageloc, setup):
+    cell = cellsize[setup['telescope']]
+    npix = 256
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---SIN'
+    header['CRVAL1'] = racentroid
+    header['CDELT1'] = -cell / 3600
+    header['CRPIX1'] = npix / 2 + 1
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRVAL2'] = deccentroid
+    header['CDELT2'] = cell / 3600
+    header['CRPIX2'] = npix / 2 + 1
+    fits.writeto(imageloc, numpy.zeros((1, 1, npix, npix), \
+            dtype=numpy.float32), header, clobber=True)
+
+# a config.py with one region of nlens lenses and nsource Gaussian sources,
+# followed by the lines of extra
+def writeconfig(configloc, setup, extra=[]):
+    lines = ["ImageName = 'image.fits'", "FitsFiles = ['vis.uvfits']", \
+            "ParallelProcessingMode = 'Threads'", "Nthreads = 1", \
+            "lnLike = 'chi2'", "RegionID = ['0']", \
+            "RACentroid = [" + str(racentroid) + "]", \
+            "DecCentroid = [" + str(deccentroid) + "]", \
+            "RadialExtent = [" + str(setup['extent']) + "]", \
+            "Oversample = [" + str(setup['oversample']) + "]", \
+            "Nlens = [" + str(setup['nlens']) + "]", \
+            "Nsource = [" + str(setup['nsource']) + "]"]
+    lens = [('EinsteinRadius', [0.2, 1.0], [0.4, 0.6]), \
+            ('DeltaRA', [-0.5, 0.5], [-0.1, 0.1]), \
+            ('DeltaDec', [-0.5, 0.5], [-0.1, 0.1]), \
+            ('AxialRatio', [0.3, 1.0], [0.7, 0.9]), \
+            ('PositionAngle', [0., 180.], [0., 180.])]
+    source = [('IntrinsicFlux', [0.1, 50.], [1., 10.]), \
+            ('Size', [0.01, 1.], [0.05, 0.3]), \
+            ('DeltaRA', [-0.5, 0.5], [-0.2, 0.2]), \
+            ('DeltaDec', [-0.5, 0.5], [-0.2, 0.2]), \
+            ('AxialRatio', [0.3, 1.0], [0.5, 0.9]), \
+            ('PositionAngle', [0., 180.], [0., 180.])]
+    for params, kind, n in [(lens, 'Lens', setup['nlens']), \
+            (source, 'Source', setup['nsource'])]:
+        for i in range(n):
+            tag = '_' + kind + str(i) + '_Region0'
+            for name, constraint, init in params:
+                lines.append('Constraint_' + name + tag + ' = ' + \
+                        str(constraint + ['free']))
+                lines.append('Init_' + name + tag + ' = ' + str(init))
+            if kind == 'Source':
+                lines.append('ModelMorphology' + tag + " = 'gaussian'")
+    lines.extend(extra)
+    configfile = open(configloc, 'w')
+    configfile.write('\n'.join(lines) + '\n')
+    configfile.close()
+
+# the data, image and config.py of a setup in rundir, removing the outputs of
+# earlier runs there
+def writefit(rundir, setup, random, extra=[]):
+    if not os.path.exists(rundir):
+        os.makedirs(rundir)
+    writeuvfits(os.path.join(rundir, 'vis.uvfits'), setup, random)
+    writeimage(os.path.join(rundir, 'image.fits'), setup)
+    writeconfig(os.path.join(rundir, 'config.py'), setup, extra)
+    for stale in ['benchmark.json', 'progress.json', 'config.pyc', \
+            'posteriorpdf.hdf5']:
+        if os.path.exists(os.path.join(rundir, stale)):
+            os.remove(os.path.join(rundir, stale))
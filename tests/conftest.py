@@ -0,0 +1,27 @@
+import os
+import sys
+import ast
+import imp
+import pytest
+
+# the modules live at the top of the repository, next to the scripts
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+# uvmcmcfit.py is a script that reads config.py and runs a fit when it is
+# imported, so the tests load only its imports and function definitions
+@pytest.fixture(scope='session')
+def uvmcmcfit():
+    path = os.path.join(root, 'uvmcmcfit.py')
+    tree = ast.parse(open(path).read(), path)
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            body.append(node)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)) and \
+                'config' not in [alias.name for alias in node.names]:
+            body.append(node)
+    module = imp.new_module('uvmcmcfit')
+    exec compile(ast.Module(body=body), path, 'exec') in module.__dict__
+    return module
@@ -0,0 +1,176 @@
+import numpy
+import pytest
+import lensutil
+import sample_vis
+
+
+# lens and source parameters, in arcsec and degrees, as used by uvmcmcfit
+lenspar = [0.8, 0.05, -0.05, 0.8, 30.]
+sourcepar = [5., 0.1, 0.12, 0.05, 0.7, 60.]
+
+
+def mapgrid(npix, extent=2.):
+    axis = numpy.linspace(-extent, extent, npix)
+    return numpy.meshgrid(axis, axis)
+
+
+# the centres of blocks of nbin x nbin pixels, as uvmcmcfit builds the native
+# grid of AdaptiveOversample from the oversampled one
+def blockmean(grid, nbin):
+    ny, nx = grid.shape
+    return grid.reshape(ny / nbin, nbin, nx / nbin, nbin).mean(axis=3).mean( \
+            axis=1)
+
+
+# a model map header for uvmodel, with pixels of step arcsec
+def modelheader(npix, step):
+    return {'NAXIS1': npix, 'NAXIS2': npix, 'CDELT1': -step / 3600., \
+            'CDELT2': step / 3600., 'CRPIX1': npix / 2 + 1, \
+            'CRPIX2': npix / 2 + 1, 'CRVAL1': 150., 'CRVAL2': 2.}
+
+
+# random visibilities out to a third of the largest spacing of the grid, with
+# 1 mJy noise
+def visibilities(step, nvis=2000):
+    random = numpy.random.RandomState(1)
+    uvmax = 0.3 / (step / 206265.)
+    u = random.uniform(-uvmax, uvmax, nvis)
+    v = random.uniform(-uvmax, uvmax, nvis)
+    return u, v, numpy.zeros(nvis) + 1e6
+
+
+def lnlike(data, model, wgt):
+    return -0.5 * (wgt * numpy.abs(data - model) ** 2).sum()
+
+
+def test_unlensed_region_models_the_unlensed_map():
+    # without a lens, lnprob's model (the lensed map) is the unlensed map of
+    # the source, as it was before lnprob switched from g_image to
+    # g_lensimage
+    x, y = mapgrid(80)
+    g_image, g_lensimage = lensutil.sbmap(x, y, 0, 1, sourcepar, \
+            ['gaussian'])[:2]
+    assert numpy.array_equal(g_lensimage, g_image)
+
+
+def test_lensed_map_depends_on_the_lens():
+    # g_image, which lnprob used to observe, ignores the lens parameters
+    x, y = mapgrid(80)
+    moved = list(lenspar)
+    moved[1] += 0.2
+    first = lensutil.sbmap(x, y, 1, 1, lenspar + sourcepar, ['gaussian'])
+    second = lensutil.sbmap(x, y, 1, 1, moved + sourcepar, ['gaussian'])
+    assert numpy.array_equal(first[0], second[0])
+    assert numpy.abs(first[1] - second[1]).max() > 0.1 * first[1].max()
+    assert numpy.isclose(first[1].sum() / first[0].sum(), first[4][0])
+
+
+@pytest.mark.parametrize('size', [0.03, 0.05, 0.15])
+@pytest.mark.parametrize('nsub', [4, 8])
+def test_adaptive_matches_uniform_oversampling(size, nsub):
+    # a source near the caustic, on 0.1 arcsec pixels
+    parameters = lenspar + [5., size, 0.75, 0.1, 0.7, 60.]
+    step = 0.1
+    nnative = 40
+    xfine, yfine = mapgrid(nnative * nsub)
+    x = blockmean(xfine, nsub)
+    y = blockmean(yfine, nsub)
+    header = modelheader(nnative, step)
+    u, v, wgt = visibilities(step)
+    pcd = [header['CRVAL1'], header['CRVAL2']]
+
+    uniform = lensutil.sbmap(xfine, yfine, 1, 1, parameters, ['gaussian'])
+    data = sample_vis.uvmodel(sample_vis.binimage(uniform[1], nsub), \
+            header, u, v, pcd)
+    adaptive = lensutil.sbmap(x, y, 1, 1, parameters, ['gaussian'], \
+            nsub=nsub)
+    model = sample_vis.uvmodel(adaptive[1], header, u, v, pcd)
+
+    # magnification to 0.2%, lnprob to 5 (it is -1e5 at native resolution
+    # for the smallest source)
+    assert numpy.abs(adaptive[4][0] / uniform[4][0] - 1) < 2e-3
+    assert lnlike(data, model, wgt) > -5.
+
+
+@pytest.mark.parametrize('nlens, parameters', [ \
+        (1, lenspar + [5., 0.15, 0.75, 0.1, 0.7, 60.]), \
+        (0, [5., 0.15, 0.3, 0.1, 0.7, 60.]), \
+        (0, [5., 0.4, 0.3, 0.1, 0.7, 60.])])
+def test_cropped_canvas_matches_full_canvas(nlens, parameters):
+    # RadialExtent = 6 on 0.1 arcsec pixels, with preset canvases of 60, 30
+    # and 15 pixels as AdaptiveCanvas makes them
+    step = 0.1
+    npix = 120
+    x, y = mapgrid(npix, 6.)
+    header = modelheader(npix, step)
+    crops = []
+    headers = []
+    ncanvas = npix / 2
+    while ncanvas >= 15:
+        off = (npix - ncanvas) / 2
+        headcanvas = dict(header)
+        headcanvas.update(NAXIS1=ncanvas, NAXIS2=ncanvas, \
+                CRPIX1=header['CRPIX1'] - off, CRPIX2=header['CRPIX2'] - off)
+        crops.insert(0, slice(off, off + ncanvas))
+        headers.insert(0, headcanvas)
+        ncanvas /= 2
+    u, v, wgt = visibilities(step)
+    pcd = [header['CRVAL1'], header['CRVAL2']]
+
+    g_lensimage = lensutil.sbmap(x, y, nlens, 1, parameters, ['gaussian'])[1]
+    full = sample_vis.uvmodel(g_lensimage, header, u, v, pcd)
+    random = numpy.random.RandomState(2)
+    data = full + 1e-3 * (random.normal(size=u.size) + \
+            1j * random.normal(size=u.size))
+
+    icrop = lensutil.smallestcrop([g_lensimage], crops, 1e-4)
+    if nlens > 0:
+        # the lensed emission reaches the edge of the map
+        assert icrop is None
+        return
+    assert icrop is not None
+    crop = crops[icrop]
+    cropped = sample_vis.uvmodel(g_lensimage[crop, crop], headers[icrop], u, \
+            v, pcd)
+    assert numpy.abs(lnlike(data, cropped, wgt) - \
+            lnlike(data, full, wgt)) < 0.05
+
+
+@pytest.mark.parametrize('nlens, parameters', [ \
+        (1, lenspar + [5., 0.15, 0.3, 0.1, 0.7, 60.]), \
+        (0, [5., 0.15, 0.3, 0.1, 0.7, 60.])])
+def test_lnlike_gradient_matches_central_differences(nlens, parameters):
+    # the gradient lnprobgrad takes back through uvmodel and sbmap, checked
+    # as CheckGradient does
+    step = 0.05
+    npix = 80
+    x, y = mapgrid(npix)
+    header = modelheader(npix, step)
+    u, v, wgt = visibilities(step)
+    pcd = [header['CRVAL1'], header['CRVAL2']]
+    truth = numpy.array(parameters, dtype=float)
+    truth[-6:-3] *= 1.1
+    data = sample_vis.uvmodel(lensutil.sbmap(x, y, nlens, 1, truth, \
+            ['gaussian'])[1], header, u, v, pcd)
+
+    def model(p):
+        g_lensimage = lensutil.sbmap(x, y, nlens, 1, p, ['gaussian'])[1]
+        return sample_vis.uvmodel(g_lensimage, header, u, v, pcd)
+
+    p = numpy.array(parameters, dtype=float)
+    residual = data - model(p)
+    gvis = wgt * numpy.real(residual) + 1j * wgt * numpy.imag(residual)
+    gmap = sample_vis.uvmodeladjoint(gvis, header, u, v, pcd)
+    gradient = lensutil.sbmapgrad(x, y, nlens, 1, p, ['gaussian'], gmap)
+
+    numeric = numpy.zeros(p.size)
+    for j in range(p.size):
+        h = 1e-5 * max(numpy.abs(p[j]), 1.)
+        phi = p.copy()
+        phi[j] += h
+        plo = p.copy()
+        plo[j] -= h
+        numeric[j] = (lnlike(data, model(phi), wgt) - \
+                lnlike(data, model(plo), wgt)) / (2 * h)
+    assert numpy.abs(gradient - numeric).max() < \
+            1e-3 * numpy.abs(numeric).max()
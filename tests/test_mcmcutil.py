@@ -0,0 +1,147 @@
+import numpy
+import emcee
+import mcmcutil
+
+
+def test_neldermead_reaches_a_known_minimum():
+    # the first simplex straddles the minimum, so its function values agree
+    # long before its vertices do
+    minimum = numpy.array([1., 2.])
+    fn = lambda p: ((p - minimum) ** 2).sum()
+    pbest, fbest = mcmcutil.neldermead(fn, numpy.zeros(2), numpy.ones(2))
+    assert numpy.allclose(pbest, minimum, atol=2e-3)
+    assert fbest < 1e-5
+
+
+def gaussian(p, mean, sigma):
+    return -0.5 * (((p - mean) / sigma) ** 2).sum(), None
+
+
+def test_delayedsampler_samples_the_target_not_the_surrogate():
+    # a unit Gaussian target screened with a shifted, wider surrogate
+    nwalkers, ndim = 16, 2
+    sampler = mcmcutil.DelayedSampler(nwalkers, ndim, gaussian, gaussian, \
+            [0.5, 1.5], args=[0., 1.])
+    sampler._random = numpy.random.RandomState(5)
+    p0 = numpy.random.RandomState(6).normal(size=(nwalkers, ndim))
+    sampler.run_mcmc(p0, 3000)
+
+    samples = sampler.chain[:, 500:].reshape(-1, ndim)
+    assert numpy.allclose(samples.mean(axis=0), 0., atol=0.1)
+    assert numpy.allclose(samples.var(axis=0), 1., atol=0.1)
+    assert 0 < sampler.nfull < sampler.nscreened
+
+    # the surrogate cache holds only the current positions
+    assert len(sampler._lnsurrogate) <= nwalkers
+    sampler.reset()
+    assert len(sampler._lnsurrogate) == 0 and sampler.nfull == 0
+
+
+def test_autocorrtime_of_an_ar1_process():
+    # x[t] = phi x[t-1] + noise has tau = (1 + phi) / (1 - phi) = 19
+    phi = 0.9
+    rng = numpy.random.RandomState(7)
+    nwalkers, nsteps = 32, 4000
+    chain = numpy.zeros((nwalkers, nsteps, 2))
+    noise = rng.normal(size=(nwalkers, nsteps, 2))
+    chain[:, 0] = noise[:, 0] / numpy.sqrt(1 - phi ** 2)
+    for t in range(1, nsteps):
+        chain[:, t] = phi * chain[:, t - 1] + noise[:, t]
+    chain[:, :, 1] = 3.
+
+    tau = mcmcutil.autocorrtime(chain)
+    assert abs(tau[0] - 19.) < 0.1 * 19.
+    assert tau[1] == numpy.inf
+
+
+def test_plateau_stops_once_the_best_value_stops_rising():
+    rising = list(numpy.arange(20.))
+    assert not mcmcutil.plateau(rising, 5, 0.5)
+    flat = rising + [19.2, 19.1, 19.3, 19.0, 19.4]
+    assert mcmcutil.plateau(flat, 5, 0.5)
+    assert not mcmcutil.plateau(flat, 5, 0.1)
+    assert not mcmcutil.plateau(flat[:5], 5, 0.5)
+
+
+def test_stuckwalkers_finds_one_stuck_walker():
+    lnprob = numpy.array([-10., -11., -9., -10.5, -12., -9.5])
+    acceptance = numpy.array([0.3, 0.25, 0.4, 0.35, 0.3, 0.2])
+
+    # walker 4 never accepts a move
+    accepted = acceptance.copy()
+    accepted[4] = 0.
+    stuck, healthy = mcmcutil.stuckwalkers(lnprob, accepted, 0.05, 20.)
+    assert list(stuck) == [4]
+    assert list(healthy) == [0, 2, 5]
+
+    # walker 1 sits far below the median lnprob
+    lowered = lnprob.copy()
+    lowered[1] = -100.
+    stuck, healthy = mcmcutil.stuckwalkers(lowered, acceptance, 0.05, 20.)
+    assert list(stuck) == [1]
+    assert list(healthy) == [0, 2, 5]
+
+    # a walker at zero posterior is stuck too
+    lowered[1] = -numpy.inf
+    stuck, healthy = mcmcutil.stuckwalkers(lowered, acceptance, 0.05, 20.)
+    assert list(stuck) == [1]
+
+
+def test_callrecorder_keeps_rejected_proposals():
+    nwalkers, ndim = 8, 2
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, gaussian, args=[0., 1.])
+    sampler._random = numpy.random.RandomState(8)
+    recorder = mcmcutil.CallRecorder(sampler, 1000, \
+            numpy.random.RandomState(9))
+    p0 = numpy.random.RandomState(10).normal(size=(nwalkers, ndim))
+    sampler.run_mcmc(p0, 10)
+
+    # the starting positions and every proposal, with their lnprob values
+    assert recorder.ncalls == nwalkers * 11 == len(recorder.sample)
+    for lnp, pos in recorder.sample:
+        assert lnp == gaussian(pos, 0., 1.)[0]
+    visited = sampler.chain.reshape(-1, ndim)
+    rejected = [pos for lnp, pos in recorder.sample \
+            if not (visited == pos).all(axis=1).any()]
+    assert len(rejected) > 0
+
+    # a smaller recorder keeps at most its size
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, gaussian, args=[0., 1.])
+    recorder = mcmcutil.CallRecorder(sampler, 5, numpy.random.RandomState(9))
+    sampler.run_mcmc(p0, 10)
+    assert recorder.ncalls == nwalkers * 11 and len(recorder.sample) == 5
+
+
+def test_reservoir_is_uniform():
+    # offer 20 items to a reservoir of 5, many times over
+    random = numpy.random.RandomState(11)
+    counts = numpy.zeros(20)
+    for trial in range(4000):
+        sample = []
+        for nseen in range(20):
+            mcmcutil.reservoir(sample, nseen, nseen, 5, random)
+        assert len(sample) == 5 and len(set(sample)) == 5
+        counts[sample] += 1
+
+    # each item is kept with probability 5 / 20
+    assert numpy.allclose(counts / 4000., 0.25, atol=0.03)
+
+
+def test_datahash_tracks_the_contents_of_the_arguments():
+    data = numpy.arange(12.).reshape(3, 4)
+    args = [data, 'chi2', {'nsigma': None, 'muthresh': 10.}, (1, 2.5)]
+    digest = mcmcutil.datahash(args)
+    assert len(digest) == 40
+
+    # equal contents hash the same, whatever the memory layout or dict order
+    same = [data.T.copy().T, 'chi2', {'muthresh': 10., 'nsigma': None}, \
+            (1, 2.5)]
+    assert mcmcutil.datahash(same) == digest
+
+    # a changed value, shape, dtype or setting does not
+    changed = data.copy()
+    changed[1, 2] += 1e-12
+    for other in [[changed] + args[1:], [data.reshape(4, 3)] + args[1:], \
+            [data.astype(numpy.float32)] + args[1:], \
+            args[:1] + ['full'] + args[2:]]:
+        assert mcmcutil.datahash(other) != digest
@@ -0,0 +1,75 @@
+import numpy
+import pytest
+from astropy.table import Table
+from astropy.io.misc import hdf5
+import modifypdf
+
+
+def test_constant_column_has_converged():
+    # exactly, although its variances are rounding errors
+    chains = numpy.zeros((3, 64)) + 7.3
+    assert modifypdf.rhat(chains) == 1.
+
+
+def test_chains_stuck_at_different_values_have_not_converged():
+    chains = numpy.zeros((3, 64)) + numpy.array([[1.], [2.], [3.]])
+    assert modifypdf.rhat(chains) == numpy.inf
+
+
+def test_nonfinite_column_is_unconverged():
+    chains = numpy.random.RandomState(1).normal(size=(3, 64))
+    chains[1, 5] = numpy.nan
+    rhats = {'lnprob': 1., 'mu_aper.Region0': modifypdf.rhat(chains)}
+    assert numpy.isnan(rhats['mu_aper.Region0'])
+    assert modifypdf.unconverged(rhats) == ['mu_aper.Region0']
+
+
+def test_merge_with_a_constant_column(tmpdir):
+    random = numpy.random.RandomState(1)
+    nwalkers = 4
+    pdflocs = []
+    for chain in range(2):
+        PDFdata = Table()
+        PDFdata['lnprob'] = random.normal(size=10 * nwalkers)
+        PDFdata['mu_aper.Region0'] = numpy.zeros(10 * nwalkers) + 0.1
+        pdfloc = str(tmpdir.join('posteriorpdf.chain' + str(chain) + \
+                '.hdf5'))
+        hdf5.write_table_hdf5(PDFdata, pdfloc, path='/posteriorpdf')
+        pdflocs.append(pdfloc)
+    rhats = modifypdf.merge(pdflocs, str(tmpdir.join('posteriorpdf.hdf5')), \
+            nwalkers=nwalkers)
+    assert rhats['mu_aper.Region0'] == 1.
+    assert modifypdf.unconverged(rhats, threshold=numpy.inf) == []
+
+
+def test_merge_reads_the_number_of_walkers(tmpdir):
+    # two chains of 10 iterations of 3 walkers; each value encodes its chain,
+    # iteration and walker
+    nwalkers = 3
+    pdflocs = []
+    for chain in range(2):
+        PDFdata = Table()
+        PDFdata['lnprob'] = 100 * chain + numpy.arange(10 * nwalkers) + 0.
+        PDFdata.meta['nwalkers'] = nwalkers
+        pdfloc = str(tmpdir.join('posteriorpdf.chain' + str(chain) + \
+                '.hdf5'))
+        hdf5.write_table_hdf5(PDFdata, pdfloc, path='/posteriorpdf')
+        pdflocs.append(pdfloc)
+    newpdfloc = str(tmpdir.join('posteriorpdf.hdf5'))
+    modifypdf.merge(pdflocs, newpdfloc)
+
+    # the last 5 iterations, interleaved one ensemble of 6 walkers
+    merged = hdf5.read_table_hdf5(newpdfloc)
+    assert merged.meta['nwalkers'] == 2 * nwalkers
+    assert list(merged['lnprob'][:2 * nwalkers]) == \
+            [15., 16., 17., 115., 116., 117.]
+    assert len(merged) == 5 * 2 * nwalkers
+
+    # chains that do not record it need nwalkers
+    PDFdata = hdf5.read_table_hdf5(pdflocs[1])
+    del PDFdata.meta['nwalkers']
+    hdf5.write_table_hdf5(PDFdata, pdflocs[1], path='/posteriorpdf', \
+            overwrite=True)
+    with pytest.raises(ValueError):
+        modifypdf.merge(pdflocs, newpdfloc)
+    modifypdf.merge(pdflocs, newpdfloc, nwalkers=nwalkers)
@@ -0,0 +1,44 @@
+import numpy
+import pytest
+import sample_vis
+
+
+# world coordinate offsets (degrees from CRVAL) of the pixel centres along
+# each axis of a map with this header, with 1-based FITS pixel numbers
+def pixelworld(header, axis):
+    npix = header['NAXIS' + axis]
+    return (numpy.arange(npix) + 1 - header['CRPIX' + axis]) * \
+            header['CDELT' + axis]
+
+
+# flux-weighted mean world position of a map
+def centroid(image, header):
+    xworld = pixelworld(header, '1')
+    yworld = pixelworld(header, '2')
+    total = image.sum()
+    return (image.sum(axis=0) * xworld).sum() / total, \
+            (image.sum(axis=1) * yworld).sum() / total
+
+
+@pytest.mark.parametrize('nbin', [2, 3, 4])
+def test_binning_preserves_flux_and_centroid(nbin):
+    # an oversampled Gaussian, off the pixel grid
+    npix = 120
+    step = 0.025
+    header = {'NAXIS1': npix, 'NAXIS2': npix, 'CDELT1': -step / 3600., \
+            'CDELT2': step / 3600., 'CRPIX1': npix / 2 + 1, \
+            'CRPIX2': npix / 2 + 1, 'CRVAL1': 150., 'CRVAL2': 2.}
+    xworld = pixelworld(header, '1') * 3600
+    yworld = pixelworld(header, '2') * 3600
+    x, y = numpy.meshgrid(xworld, yworld)
+    image = numpy.exp(-0.5 * ((x + 0.137) ** 2 + (y - 0.211) ** 2) / 0.2 ** 2)
+
+    binned = sample_vis.binimage(image, nbin)
+    binnedheader = sample_vis.binheader(header, nbin)
+    assert binned.shape == (npix / nbin, npix / nbin)
+    assert binnedheader['NAXIS1'] == npix / nbin
+    assert numpy.allclose(binned.sum(), image.sum(), rtol=1e-12)
+    assert numpy.allclose(centroid(binned, binnedheader), \
+            centroid(image, header), rtol=0, atol=1e-6 * step / 3600.)
+    assert numpy.allclose(centroid(image, header), \
+            (-0.137 / 3600., 0.211 / 3600.), rtol=1e-3)
@@ -0,0 +1,21 @@
+import stagetimer
+
+
+def test_prefixed_stages_are_kept_apart():
+    stagetimer.enable()
+    try:
+        t = stagetimer.clock()
+        stagetimer.lap('fft2', t)
+        stagetimer.setprefix('surrogate_')
+        t = stagetimer.clock()
+        stagetimer.lap('fft2', t)
+        stagetimer.lap('fft2', t)
+        stagetimer.setprefix()
+        latest = {}
+        stagetimer.collect(latest, stagetimer.snapshot())
+        totals = stagetimer.total(latest)
+        assert totals['fft2'][0] == 1
+        assert totals['surrogate_fft2'][0] == 2
+    finally:
+        stagetimer.enable(False)
+        stagetimer.stats.clear()
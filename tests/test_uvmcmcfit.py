@@ -0,0 +1,322 @@
+import numpy
+import pytest
+import lensutil
+import sample_vis
+
+
+# a model map header with pixels of step arcsec at ra0, dec0
+def imageheader(step, ra0=150., dec0=2.):
+    return {'NAXIS1': 1, 'NAXIS2': 1, 'CDELT1': -step / 3600., \
+            'CDELT2': step / 3600., 'CRPIX1': 1, 'CRPIX2': 1, \
+            'CRVAL1': ra0, 'CRVAL2': dec0}
+
+
+def test_planmerge_groups_compatible_nearby_regions(uvmcmcfit):
+    # regions 0, 1 and 3 are close together; 2 has another pixel scale and
+    # 4 is too far away for a canvas of at most 128 pixels
+    offx = [0., 1.5, 0.5, -0.7, 30.]
+    offy = [0., -0.8, 0.4, 1.1, 0.]
+    extents = [1., 1., 1., 0.5, 1.]
+    step = [0.05, 0.05, 0.1, 0.05, 0.05]
+    plans = uvmcmcfit.planmerge(offx, offy, extents, step, [1] * 5, \
+            [1] * 5, 128)
+    assert [plan[0] for plan in plans] == [[0, 1, 3]]
+
+    members, cx, cy, ncanvas, xshared, yshared = plans[0]
+    assert numpy.allclose((cx, cy), (numpy.mean([0., 1.5, -0.7]), \
+            numpy.mean([0., -0.8, 1.1])))
+    assert ncanvas % 2 == 0 and ncanvas <= 128
+    assert xshared.shape == (ncanvas, ncanvas)
+    assert numpy.allclose(numpy.diff(xshared[0]), 0.05)
+    assert numpy.allclose(numpy.diff(yshared[:, 0]), 0.05)
+
+    # every region's patch is centred on its centroid and covers its extent
+    for i in members:
+        rows, cols = uvmcmcfit.mergepatch(xshared, yshared, offx[i], \
+                offy[i], extents[i], 0.05)
+        x = xshared[rows, cols] - offx[i]
+        y = yshared[rows, cols] - offy[i]
+        assert numpy.allclose([x.min(), x.max()], [-extents[i], extents[i]], \
+                atol=0.5 * 0.05)
+        assert numpy.allclose([y.min(), y.max()], [-extents[i], extents[i]], \
+                atol=0.5 * 0.05)
+
+
+def test_mergeheader_places_the_canvas_on_the_sky(uvmcmcfit):
+    ra0 = 150.
+    dec0 = 60.
+    cosdec0 = numpy.cos(dec0 * numpy.pi / 180)
+    offx = [0., 2.]
+    offy = [0., -1.]
+    plans = uvmcmcfit.planmerge(offx, offy, [1., 1.], [0.1, 0.1], [2, 2], \
+            [1, 1], 512)
+    members, cx, cy, ncanvas, xshared, yshared = plans[0]
+    assert ncanvas % 4 == 0
+    header = uvmcmcfit.mergeheader(imageheader(0.1, ra0, dec0), ra0, dec0, \
+            cx, cy, ncanvas, 0.1, 1)
+
+    # the world coordinates of every pixel centre, from the header, are those
+    # of its model coordinates (arcsec west and north of region 0)
+    cols = numpy.arange(ncanvas) + 1
+    ra = header['CRVAL1'] + (cols - header['CRPIX1']) * header['CDELT1'] / \
+            cosdec0
+    dec = header['CRVAL2'] + (cols - header['CRPIX2']) * header['CDELT2']
+    assert numpy.allclose(ra, ra0 - xshared[0] / 3600 / cosdec0, rtol=0, \
+            atol=1e-9)
+    assert numpy.allclose(dec, dec0 + yshared[:, 0] / 3600, rtol=0, atol=1e-9)
+
+    # binning keeps the centre of the canvas
+    binned = uvmcmcfit.mergeheader(imageheader(0.1, ra0, dec0), ra0, dec0, \
+            cx, cy, ncanvas, 0.1, 2)
+    assert binned['NAXIS1'] == ncanvas / 2
+    assert binned == sample_vis.binheader(header, 2)
+
+
+def test_merged_canvas_matches_the_sum_of_the_regions(uvmcmcfit):
+    # two unlensed regions of one Gaussian source each, observed together on
+    # their shared canvas, and each on its own map centred on its centroid as
+    # without MergeRegions.  The offsets are whole pixels, so that both see
+    # the sources at the same pixel centres.
+    ra0 = 150.
+    dec0 = 2.
+    cosdec0 = numpy.cos(dec0 * numpy.pi / 180)
+    step = 0.05
+    offx = [0., 1.2]
+    offy = [0., -0.6]
+    extents = [1., 1.]
+    sources = [[5., 0.15, 0.1, -0.05, 0.7, 60.], \
+            [3., 0.2, -0.1, 0.1, 0.5, 10.]]
+    plans = uvmcmcfit.planmerge(offx, offy, extents, [step, step], [1, 1], \
+            [1, 1], 512)
+    members, cx, cy, ncanvas, xshared, yshared = plans[0]
+    header = uvmcmcfit.mergeheader(imageheader(step, ra0, dec0), ra0, dec0, \
+            cx, cy, ncanvas, step, 1)
+
+    random = numpy.random.RandomState(1)
+    uvmax = 0.1 / (step / 206265.)
+    u = random.uniform(-uvmax, uvmax, 2000)
+    v = random.uniform(-uvmax, uvmax, 2000)
+    pcd = [ra0, dec0]
+
+    canvas = numpy.zeros((ncanvas, ncanvas))
+    separate = 0.
+    for i in members:
+        rows, cols = uvmcmcfit.mergepatch(xshared, yshared, offx[i], \
+                offy[i], extents[i], step)
+        canvas[rows, cols] += lensutil.sbmap(xshared[rows, cols] - offx[i], \
+                yshared[rows, cols] - offy[i], 0, 1, sources[i], \
+                ['gaussian'])[1]
+
+        npix = int(round(2 * extents[i] / step))
+        own = imageheader(step, ra0 - offx[i] / 3600 / cosdec0, \
+                dec0 + offy[i] / 3600)
+        own.update(NAXIS1=npix, NAXIS2=npix, CRPIX1=npix / 2 + 1, \
+                CRPIX2=npix / 2 + 1)
+        indx = (numpy.arange(npix) - npix / 2) * step
+        x, y = numpy.meshgrid(indx, indx)
+        image = lensutil.sbmap(x, y, 0, 1, sources[i], ['gaussian'])[1]
+        separate = separate + sample_vis.uvmodel(image, own, u, v, pcd)
+    merged = sample_vis.uvmodel(canvas, header, u, v, pcd)
+
+    # up to the gridding errors of FFT grids of different sizes (about 1e-3);
+    # a canvas one pixel off would be wrong by tens of per cent
+    assert numpy.abs(merged - separate).max() < \
+            5e-3 * numpy.abs(separate).max()
+
+
+def test_fluxsolve_recovers_the_fluxes_of_two_sources(uvmcmcfit):
+    # two sources of fixed shape, observed at known fluxes with noise
+    rng = numpy.random.RandomState(3)
+    nvis = 400
+    u = rng.uniform(-1, 1, nvis)
+    v = rng.uniform(-1, 1, nvis)
+    templates = [numpy.exp(-(u ** 2 + v ** 2)), \
+            numpy.exp(-0.3 * (u ** 2 + v ** 2)) * \
+            numpy.exp(2j * numpy.pi * (0.4 * u - 0.2 * v))]
+    flux = numpy.array([2.5, 0.7])
+    sigma = 0.01
+    model = flux[0] * templates[0] + flux[1] * templates[1]
+    real = model.real + rng.normal(0, sigma, nvis)
+    imag = model.imag + rng.normal(0, sigma, nvis)
+    wgt = numpy.ones(nvis) / sigma ** 2
+    pzero = numpy.zeros(3)
+    fluxlo = numpy.zeros(2)
+    fluxhi = numpy.array([10., 10.])
+
+    bestflux, recorded, lnmarg = uvmcmcfit.fluxsolve(templates, real, \
+            imag, wgt, fluxlo, fluxhi, 'profile', pzero)
+    assert numpy.allclose(bestflux, flux, atol=5 * sigma)
+    assert numpy.all(recorded == bestflux) and lnmarg == 0
+
+    # the recorded fluxes of 'marginalise' are a draw near the best fit
+    bestflux, recorded, lnmarg = uvmcmcfit.fluxsolve(templates, real, \
+            imag, wgt, fluxlo, fluxhi, 'marginalise', pzero)
+    assert numpy.allclose(bestflux, flux, atol=5 * sigma)
+    assert numpy.allclose(recorded, flux, atol=10 * sigma)
+
+    # the flux limits still hold for the profile fluxes
+    bestflux, recorded, lnmarg = uvmcmcfit.fluxsolve(templates, real, \
+            imag, wgt, fluxlo, numpy.array([2., 10.]), 'profile', pzero)
+    assert bestflux[0] == 2.
+
+
+def test_profileflux_rejects_mergeregions(uvmcmcfit):
+    class config:
+        ProfileFlux = 'profile'
+        MergeRegions = True
+    with pytest.raises(ValueError):
+        uvmcmcfit.checkoptions(config)
+    config.MergeRegions = False
+    uvmcmcfit.checkoptions(config)
+
+
+def test_calmarg_matches_numerical_integration_over_the_gain(uvmcmcfit):
+    # two files with different amplitude errors and a model that is 10 per
+    # cent too faint for the first file and 5 per cent too bright for the
+    # second
+    rng = numpy.random.RandomState(4)
+    nvis = 60
+    model_real = rng.normal(0, 1, nvis)
+    model_imag = rng.normal(0, 1, nvis)
+    gain = numpy.repeat([1.1, 0.95], nvis // 2)
+    real = gain * model_real + rng.normal(0, 0.3, nvis)
+    imag = gain * model_imag + rng.normal(0, 0.3, nvis)
+    wgt = numpy.ones(nvis) / 0.3 ** 2
+    filebounds = [(0, nvis // 2), (nvis // 2, nvis)]
+    amperror = [0.1, 0.05]
+
+    lncal = uvmcmcfit.calmarg(real, imag, wgt, model_real, model_imag, \
+            filebounds, amperror)
+
+    # ln of int N(g; 1, s^2) L(g) dg / L(1), file by file, on a fine grid
+    expected = 0.
+    for (start, stop), s in zip(filebounds, amperror):
+        g = numpy.linspace(1 - 10 * s, 1 + 10 * s, 20001)
+        chi2 = [(wgt[start:stop] * ((real[start:stop] - gi * \
+                model_real[start:stop]) ** 2 + (imag[start:stop] - gi * \
+                model_imag[start:stop]) ** 2)).sum() for gi in g]
+        chi2 = numpy.array(chi2)
+        chi2one = (wgt[start:stop] * ((real[start:stop] - \
+                model_real[start:stop]) ** 2 + (imag[start:stop] - \
+                model_imag[start:stop]) ** 2)).sum()
+        integrand = numpy.exp(-0.5 * (chi2 - chi2one) - \
+                0.5 * (g - 1) ** 2 / s ** 2) / numpy.sqrt(2 * numpy.pi) / s
+        expected += numpy.log(numpy.trapz(integrand, g))
+
+    assert abs(lncal - expected) < 1e-6
+    assert abs(lncal) > 1
+
+
+def test_tied_parameters_are_expanded_and_written(uvmcmcfit):
+    # parameter 1 is tied to parameter 0 at a fixed offset of 0.3,
+    # parameter 3 to parameter 2 at an offset that is sampled, and
+    # parameter 4 is a flux solved for in lnprob
+    fixindx = numpy.array([-1, 0, -1, 2, -1])
+    p_l = numpy.array([0., 0.3, -1., -0.5, -numpy.inf])
+    p_u = numpy.array([1., 0.3, 1., 0.5, numpy.inf])
+    pfull = numpy.zeros(5)
+    pfull[4] = 1.
+    sampledindx, pinned = uvmcmcfit.pinparams(pfull, numpy.arange(4), \
+            p_l, p_u)
+    assert list(sampledindx) == [0, 2, 3] and list(pinned) == [1]
+    assert pfull[1] == 0.3
+
+    pos = numpy.array([0.5, 0.2, -0.1])
+    pzero = pfull.copy()
+    pzero[sampledindx] = pos
+    parameters = uvmcmcfit.tieparams(pzero, fixindx)
+    assert numpy.allclose(parameters, [0.5, 0.8, 0.2, 0.1, 1.])
+
+    # the posterior records every named parameter as it is configured (ties
+    # as offsets), then the solved flux and the magnifications
+    blob = numpy.array([2.5, 7., 8.])
+    row = uvmcmcfit.posteriorrow(-3., pos, blob, pfull, sampledindx, [4], 1)
+    assert numpy.allclose(row, [-3., 0.5, 0.3, 0.2, -0.1, 2.5, 7., 8.])
+
+
+def test_lnprob_counts_the_real_and_imaginary_chi2(uvmcmcfit):
+    # one unlensed Gaussian source observed with known residuals, and one
+    # visibility whose imaginary part is missing
+    step, npix, ra0, dec0 = 0.05, 40, 150., 2.
+    header = imageheader(step, ra0, dec0)
+    header.update(NAXIS1=npix, NAXIS2=npix, CRPIX1=npix / 2 + 1, \
+            CRPIX2=npix / 2 + 1)
+    indx = (numpy.arange(npix) - npix / 2) * step
+    x, y = numpy.meshgrid(indx, indx)
+    source = numpy.array([4., 0.2, 0.1, -0.05, 0.7, 30.])
+
+    random = numpy.random.RandomState(2)
+    uvmax = 0.1 / (step / 206265.)
+    u = random.uniform(-uvmax, uvmax, 50)
+    v = random.uniform(-uvmax, uvmax, 50)
+    pcd = [ra0, dec0]
+    image = lensutil.sbmap(x, y, 0, 1, source, ['gaussian'])[1]
+    model = sample_vis.uvmodel(image, header, u, v, pcd)
+    wgt = random.uniform(1, 4, 50)
+    residual_real = random.normal(0, 1, 50) / numpy.sqrt(wgt)
+    residual_imag = random.normal(0, 1, 50) / numpy.sqrt(wgt)
+    real = model.real + residual_real
+    imag = model.imag + residual_imag
+    imag[7] = numpy.nan
+
+    nparams = source.size
+    args = [numpy.zeros(nparams), numpy.arange(nparams), \
+            source + 10, source - 10, numpy.zeros(nparams) - 1, \
+            real, imag, wgt, u, v, pcd, 'chi2', [x], [y], [header], \
+            step, ['gaussian'], 1, [0], [1], [1], [1], [[]], 1e-4, [], \
+            [None], False, None, None, [(0, 50)], None, {}]
+    probln, amp = uvmcmcfit.lnprob(source, *args)
+
+    good = numpy.arange(50) != 7
+    chi2 = (wgt * residual_real ** 2).sum() + \
+            (wgt * residual_imag ** 2)[good].sum()
+    assert numpy.allclose(probln, -0.5 * chi2, rtol=1e-10)
+
+
+def test_lnprobgrad_moves_tied_parameters_together(uvmcmcfit):
+    # two unlensed Gaussian sources, the DeltaRA of the second tied to that
+    # of the first at a sampled offset
+    step, npix, ra0, dec0 = 0.05, 40, 150., 2.
+    header = imageheader(step, ra0, dec0)
+    header.update(NAXIS1=npix, NAXIS2=npix, CRPIX1=npix / 2 + 1, \
+            CRPIX2=npix / 2 + 1)
+    indx = (numpy.arange(npix) - npix / 2) * step
+    x, y = numpy.meshgrid(indx, indx)
+    pzero = numpy.array([4., 0.2, 0.1, -0.05, 0.7, 30., \
+            2., 0.15, -0.2, 0.1, 0.6, 80.])
+    fixindx = numpy.zeros(12) - 1
+    fixindx[8] = 2
+
+    random = numpy.random.RandomState(3)
+    uvmax = 0.1 / (step / 206265.)
+    u = random.uniform(-uvmax, uvmax, 50)
+    v = random.uniform(-uvmax, uvmax, 50)
+    pcd = [ra0, dec0]
+    real = random.normal(0, 1, 50)
+    imag = random.normal(0, 1, 50)
+    wgt = numpy.ones(50)
+    args = [numpy.zeros(12), numpy.arange(12), pzero + 10, pzero - 10, \
+            fixindx, real, imag, wgt, u, v, pcd, 'chi2', [x], [y], \
+            [header], step, ['gaussian', 'gaussian'], 1, [0], [2], [1], \
+            [1], [[]], 1e-4, [], [None], False, None, None, [(0, 50)], \
+            None, {'nsigma': None}]
+
+    gradient = uvmcmcfit.lnprobgrad(pzero, *args)
+    for j in [2, 8]:
+        dp = numpy.zeros(12)
+        dp[j] = 1e-5
+        numerical = (uvmcmcfit.lnprob(pzero + dp, *args)[0] - \
+                uvmcmcfit.lnprob(pzero - dp, *args)[0]) / 2e-5
+        assert numpy.allclose(gradient[j], numerical, rtol=1e-3)
+
+
+def test_walltime_must_outlast_its_margin(uvmcmcfit):
+    class config:
+        WallTime = 60.
+    with pytest.raises(ValueError):
+        uvmcmcfit.checkoptions(config)
+    config.WallTimeMargin = 10.
+    uvmcmcfit.checkoptions(config)
+    config.WallTime = 5.
+    with pytest.raises(ValueError):
+        uvmcmcfit.checkoptions(config)
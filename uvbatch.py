@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Run uvmcmcfit on many targets on one node, within a budget of cores.
+
+USAGE
+
+ python $PYSRC/uvbatch.py ncores uvfit00 uvfit01 ...
+
+ Every directory holds its own config.py.  The runs are started as
+ subprocesses, largest first, each with a share of the ncores cores in
+ proportion to its estimated cost (the size of its uvfits files), and at
+ most 16 (half the walkers, which is as many as emcee evaluates at once).
+ A run starts whenever enough cores are free, so the node is neither idle
+ nor oversubscribed.  The output of each run goes to uvmcmcfit.log in its
+ directory.  A directory whose config.py or uvfits files cannot be read is
+ reported as failed, and the other runs go ahead.
+
+ Cores freed by finished runs go to the runs that start after them: a run
+ also gets the free cores that no waiting run needs, up to 16.  A running
+ fit keeps the cores it started with, as uvmcmcfit cannot resize its pool;
+ only a restarted one is given a new number.
+
+ A run that fails is restarted, up to twice; it resumes from the
+ posteriorpdf.hdf5 it has written so far.  When all runs
+ have finished, a summary of the status, wall time, cores and MCMC
+ iterations of each run is printed.
+
+ The scheduler polls its subprocesses rather than using asyncio, which the
+ Python 2 code base does not have.
+"""
+
+import os
+import sys
+import time
+import imp
+import subprocess
+from astropy.io.misc import hdf5
+
+nwalkers = 32
+maxthreads = nwalkers / 2
+maxretries = 2
+pollinterval = 10.
+
+uvmcmcfitloc = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        'uvmcmcfit.py')
+
+
+# estimated cost of a fit: the total size of its visibility files.  Raises
+# IOError or OSError if its config.py or one of its FitsFiles is missing
+def fitcost(fitdir):
+    config = imp.load_source('config_' + str(abs(hash(fitdir))), \
+            os.path.join(fitdir, 'config.py'))
+    return sum([os.path.getsize(os.path.join(fitdir, fitsfile)) \
+            for fitsfile in config.FitsFiles])
+
+# number of MCMC iterations written to a fit's posterior so far
+def fititerations(fitdir):
+    posteriorloc = os.path.join(fitdir, 'posteriorpdf.hdf5')
+    if not os.path.exists(posteriorloc):
+        return 0
+    return len(hdf5.read_table_hdf5(posteriorloc)) / nwalkers
+
+
+ncores = int(sys.argv[1])
+fitdirs = sys.argv[2:]
+
+# share of the cores for each fit, in proportion to its cost; a fit whose
+# files cannot be read fails without stopping the others
+status = {}
+costs = {}
+for fitdir in fitdirs:
+    try:
+        costs[fitdir] = fitcost(fitdir)
+    except EnvironmentError as error:
+        status[fitdir] = 'failed (' + str(error) + ')'
+        print fitdir + ': ' + status[fitdir]
+totalcost = float(max(sum(costs.values()), 1))
+shares = {}
+for fitdir in costs:
+    share = int(round(ncores * costs[fitdir] / totalcost))
+    shares[fitdir] = max(1, min(share, maxthreads, ncores))
+
+# cores each fit was last started on
+cores = dict([(fitdir, 0) for fitdir in fitdirs])
+
+queue = sorted(costs, key=lambda fitdir: -costs[fitdir])
+running = {}
+retries = dict([(fitdir, 0) for fitdir in fitdirs])
+walltime = dict([(fitdir, 0.) for fitdir in fitdirs])
+startiters = dict([(fitdir, fititerations(fitdir)) for fitdir in fitdirs])
+starttime = time.time()
+busy = 0.
+
+while len(queue) > 0 or len(running) > 0:
+
+    # start the largest waiting fits that fit in the free cores, each also
+    # given the free cores that the fits still waiting do not need
+    free = ncores - sum([cores[fitdir] for fitdir in running])
+    for fitdir in list(queue):
+        if shares[fitdir] <= free:
+            queue.remove(fitdir)
+            spare = free - shares[fitdir] - sum([shares[waiting] \
+                    for waiting in queue])
+            cores[fitdir] = min(shares[fitdir] + max(spare, 0), maxthreads)
+            env = os.environ.copy()
+            env['UVMCMCFIT_NTHREADS'] = str(cores[fitdir])
+            log = open(os.path.join(fitdir, 'uvmcmcfit.log'), 'a')
+            process = subprocess.Popen([sys.executable, uvmcmcfitloc], \
+                    cwd=fitdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            running[fitdir] = (process, log, time.time())
+            free -= cores[fitdir]
+            print 'Started ' + fitdir + ' on ' + str(cores[fitdir]) + \
+                    ' cores'
+
+    time.sleep(pollinterval)
+    busy += pollinterval * sum([cores[fitdir] for fitdir in running])
+
+    # collect the finished fits, restarting the failed ones
+    for fitdir in list(running):
+        process, log, start = running[fitdir]
+        returncode = process.poll()
+        if returncode is None:
+            continue
+        log.close()
+        del running[fitdir]
+        walltime[fitdir] += time.time() - start
+        if returncode == 0:
+            status[fitdir] = 'done'
+        elif retries[fitdir] < maxretries:
+            retries[fitdir] += 1
+            queue.insert(0, fitdir)
+            print fitdir + ' failed (exit code ' + str(returncode) + \
+                    '); restarting from its posterior'
+            continue
+        else:
+            status[fitdir] = 'failed (exit code ' + str(returncode) + ')'
+        print fitdir + ': ' + status[fitdir]
+
+elapsed = time.time() - starttime
+print ''
+print 'Summary of ' + str(len(fitdirs)) + ' fits in ' + \
+        str(elapsed / 3600.) + ' hours, using ' + \
+        str(100. * busy / (ncores * elapsed)) + '% of ' + str(ncores) + \
+        ' cores'
+for fitdir in fitdirs:
+    niter = fititerations(fitdir) - startiters[fitdir]
+    print fitdir + ': ' + status[fitdir] + ', ' + str(cores[fitdir]) + \
+            ' cores, ' + str(walltime[fitdir] / 3600.) + ' hours, ' + \
+            str(niter) + ' iterations (' + \
+            str(3600. * niter / max(walltime[fitdir], 1.)) + ' per hour), ' + \
+            str(retries[fitdir]) + ' restarts'
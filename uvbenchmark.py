@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of uvmcmcfit on synthetic data.
+
+USAGE
+
+ python $PYSRC/uvbenchmark.py [results] [ncalls] [previous]
+
+ For every configuration in setups below, a directory under uvbenchmark/
+ gets a synthetic uvfits file, in the 7-axis ALMA layout (with spectral
+ windows, an AIPS FQ and an AIPS SU table) or the 6-axis PdBI layout that
+ uvutil.uvload and uvutil.visload read, an image of the field and a
+ config.py.  uvmcmcfit is then run there with UVMCMCFIT_BENCHMARK set, so
+ that it reads and prepares the data as usual, times ncalls (default 50)
+ single-threaded lnprob calls, and exits.
+
+ The configurations start from one ALMA setup and vary one thing at a
+ time: the number of visibilities, channels, polarizations and spectral
+ windows, the telescope, the size of the model map (RadialExtent),
+ Oversample, Nlens and Nsource.  For each, the startup time (in all, and
+ preparing the data), the time of the first lnprob call, lnprob calls per
+ second, and the measured and estimated peak memory are printed and
+ written, with the configuration and the versions used, to the JSON file
+ results (default uvbenchmark.json).  If the results file of an earlier
+ benchmark is given as previous, the ratio of lnprob calls per second to it
+ is printed for every configuration it shares.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy
+import astropy
+import synthetic
+
+uvmcmcfitloc = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        'uvmcmcfit.py')
+
+# the setup every configuration starts from, and the values each setting
+# takes in turn
+basesetup = {'telescope': 'ALMA', 'nvis': 5000, 'nchan': 1, 'npol': 2, \
+        'nspw': 1, 'extent': 2., 'oversample': 2, 'nlens': 1, 'nsource': 1}
+variations = [('nvis', [1000, 5000, 20000, 80000]), ('nchan', [1, 4, 16]), \
+        ('npol', [1, 2]), ('nspw', [1, 4]), ('telescope', ['ALMA', 'PdBI']), \
+        ('extent', [1., 2., 4.]), ('oversample', [1, 2, 4]), \
+        ('nlens', [0, 1, 2]), ('nsource', [1, 2, 3])]
+
+
+def setupname(setup):
+    return '_'.join([key + str(setup[key]) for key in sorted(setup)])
+
+# every distinct configuration, the base setup first
+def setups():
+    result = [dict(basesetup)]
+    for key, values in variations:
+        for value in values:
+            setup = dict(basesetup)
+            setup[key] = value
+            if setup['telescope'] == 'PdBI':
+                setup['nspw'] = 1
+            if setup not in result:
+                result.append(setup)
+    return result
+
+# prepare the directory of a configuration and benchmark uvmcmcfit in it
+def runsetup(setup, ncalls, random):
+    rundir = os.path.join('uvbenchmark', setupname(setup))
+    synthetic.writefit(rundir, setup, random)
+
+    env = os.environ.copy()
+    env['UVMCMCFIT_BENCHMARK'] = str(ncalls)
+    env['UVMCMCFIT_NTHREADS'] = '1'
+    log = open(os.path.join(rundir, 'uvmcmcfit.log'), 'w')
+    start = time.time()
+    status = subprocess.call([sys.executable, uvmcmcfitloc], cwd=rundir, \
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+    walltime = time.time() - start
+    log.close()
+    if status != 0:
+        return {'error': 'exit code ' + str(status) + ', see ' + \
+                os.path.join(rundir, 'uvmcmcfit.log')}
+    result = json.load(open(os.path.join(rundir, 'benchmark.json')))
+
+    # the whole run, including starting python and the imports, less the
+    # lnprob calls
+    result['walltime'] = walltime
+    result['launch'] = walltime - result['firstcall'] - \
+            result['calls'] * result['percall']
+    return result
+
+
+if len(sys.argv) > 1:
+    resultsloc = sys.argv[1]
+else:
+    resultsloc = 'uvbenchmark.json'
+if len(sys.argv) > 2:
+    ncalls = int(sys.argv[2])
+else:
+    ncalls = 50
+previous = {}
+if len(sys.argv) > 3:
+    for entry in json.load(open(sys.argv[3]))['results']:
+        previous[setupname(entry['setup'])] = entry
+
+random = numpy.random.RandomState(1)
+results = []
+for setup in setups():
+    result = runsetup(setup, ncalls, random)
+    results.append({'setup': setup, 'result': result})
+    line = setupname(setup) + ': '
+    if 'error' in result:
+        line += result['error']
+    else:
+        line += str(result['lnprobrate']) + ' lnprob calls per second, ' + \
+                str(result['launch']) + ' s startup (' + \
+                str(result['startup']) + ' s preparing the data), ' + \
+                str(result['peakmemory']) + ' MB peak (' + \
+                str(result['estimatedmemory']) + ' MB estimated)'
+        old = previous.get(setupname(setup), {}).get('result', {})
+        if 'lnprobrate' in old:
+            line += ', ' + str(result['lnprobrate'] / old['lnprobrate']) + \
+                    ' times ' + sys.argv[3]
+    print line
+
+environment = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), \
+        'host': platform.node(), 'python': platform.python_version(), \
+        'numpy': numpy.__version__, 'astropy': astropy.__version__, \
+        'ncalls': ncalls}
+resultsfile = open(resultsloc, 'w')
+json.dump({'environment': environment, 'results': results}, resultsfile, \
+        indent=1, sort_keys=True)
+resultsfile.close()
+print 'Results written to ' + resultsloc
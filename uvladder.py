@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Fit a ladder of progressively harder problems with uvmcmcfit, each stage
+starting its walkers from the last positions of the previous stage.
+
+USAGE
+
+ python $PYSRC/uvladder.py [command]
+
+ command runs one uvmcmcfit stage and defaults to "python uvmcmcfit.py" from
+ the same directory as this script; pass e.g. "mpirun -np 16 python
+ $PYSRC/uvmcmcfit.py" for MPI runs.
+
+ config.py must define Ladder, a list with one dictionary of settings per
+ stage, cheapest first.  The settings of a stage override those in config.py
+ while it runs.  For example:
+
+ Ladder = [{'UVMax': 2e5, 'Oversample': [1], 'PlateauIterations': 50,
+            'Iterations': 1000},
+           {'Oversample': [2], 'PlateauIterations': 100, 'Iterations': 2000},
+           {}]
+
+ The posterior of stage i is kept as posteriorpdf.stage<i>.hdf5, and the
+ final stage writes posteriorpdf.hdf5 as usual.  Each posterior holds only
+ the iterations of its own stage, not the walker positions it started from.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+from astropy.io.misc import hdf5
+
+cwd = os.getcwd()
+sys.path.append(cwd)
+import config
+
+
+if len(sys.argv) > 1:
+    command = sys.argv[1:]
+else:
+    command = [sys.executable, os.path.join(os.path.dirname( \
+            os.path.abspath(__file__)), 'uvmcmcfit.py')]
+
+# number of walkers, to seed each stage with the last positions only
+nwalkers = 32
+
+posteriorloc = 'posteriorpdf.hdf5'
+nstages = len(config.Ladder)
+for stage in range(nstages):
+    print 'Ladder stage ' + str(stage + 1) + ' of ' + str(nstages) + ': ' + \
+            str(config.Ladder[stage])
+    env = os.environ.copy()
+    env['UVMCMCFIT_STAGE'] = str(stage)
+    status = subprocess.call(command, env=env)
+    if status != 0:
+        sys.exit('Ladder stage ' + str(stage + 1) + ' failed')
+
+    if stage == nstages - 1:
+        break
+
+    # keep this stage's posterior, and start the next stage from its last
+    # walker positions.  Their lnprob is that of this stage's settings, so
+    # they are marked as a seed, which the next stage does not keep in its
+    # posterior
+    stageloc = 'posteriorpdf.stage' + str(stage) + '.hdf5'
+    shutil.move(posteriorloc, stageloc)
+    posteriordat = hdf5.read_table_hdf5(stageloc)
+    seeddat = posteriordat[-nwalkers:]
+    seeddat.meta.clear()
+    seeddat.meta['ladderseed'] = stage
+    hdf5.write_table_hdf5(seeddat, posteriorloc, \
+            path = '/posteriorpdf', overwrite=True, compression=True)
@@ -74,8 +74,13 @@
 
 # import the required modules
 import os
+import time
 import os.path
 import sys
+import json
+import cPickle
+import cProfile
+import pstats
 from astropy.io import fits
 from astropy.io.misc import hdf5
 import numpy
@@ -87,18 +92,157 @@ from emcee.utils import MPIPool
 import sample_vis
 import lensutil
 import uvutil
+import mcmcutil
+import stagetimer
+import multiprocessing
 
+# the memory of the interpreter and the imported modules, which every worker
+# holds as well (see the memory plan below)
+importrss = mcmcutil.rss()
+
+# the run's wall-clock time is counted from here
+runstart = time.time()
 
 cwd = os.getcwd()
 sys.path.append(cwd)
 import config
 
+# when run as one stage of a coarse-to-fine ladder (see uvladder.py), that
+# stage's settings override the ones in config.py
+ladderstage = os.environ.get('UVMCMCFIT_STAGE')
+if ladderstage is not None:
+    for key, value in config.Ladder[int(ladderstage)].items():
+        setattr(config, key, value)
+
+# the posterior and progress files; each independent ensemble of a job array
+# (see mergepdf.py) writes its own, and gets its own random seed
+posteriorloc = 'posteriorpdf.hdf5'
+progressloc = 'progress.json'
+seed = getattr(config, 'Seed', None)
+chainid = os.environ.get('UVMCMCFIT_CHAIN')
+if chainid is not None:
+    posteriorloc = 'posteriorpdf.chain' + chainid + '.hdf5'
+    progressloc = 'progress.chain' + chainid + '.json'
+    if seed is None:
+        seed = 0
+    seed += int(chainid)
+if seed is not None:
+    numpy.random.seed(seed)
+
+# optionally time the stages of every lnprob call (see stagetimer.py)
+timestages = getattr(config, 'TimeStages', False)
+stagetimer.enable(timestages)
+
+# reject combinations of options that the fit cannot honour, before any work
+# is done.  ProfileFlux renders every source on its own unit-flux map, which a
+# shared MergeRegions canvas cannot provide, and a WallTime no longer than its
+# WallTimeMargin would stop the run before its first iteration.
+def checkoptions(config):
+
+    if getattr(config, 'ProfileFlux', False) and \
+            getattr(config, 'MergeRegions', False):
+        raise ValueError('ProfileFlux cannot be combined with MergeRegions')
+    walltime = getattr(config, 'WallTime', None)
+    walltimemargin = getattr(config, 'WallTimeMargin', 60.)
+    if walltime is not None and walltime <= walltimemargin:
+        raise ValueError('WallTime (' + str(walltime) + ' s) must be ' + \
+                'longer than WallTimeMargin (' + str(walltimemargin) + ' s)')
+
+# solve for the source fluxes given the model visibilities of every source at
+# unit flux.  The model is linear in the fluxes, so this is a weighted linear
+# least-squares problem.
+def fluxsolve(templates, real, imag, wgt, fluxlo, fluxhi, mode, pzero):
+
+    nflux = len(templates)
+    treal = numpy.array([numpy.real(template) for template in templates])
+    timag = numpy.array([numpy.imag(template) for template in templates])
+
+    # normal equations
+    alpha = numpy.dot(treal * wgt, treal.T) + numpy.dot(timag * wgt, timag.T)
+    beta = numpy.dot(treal, wgt * real) + numpy.dot(timag, wgt * imag)
+    try:
+        cov = numpy.linalg.inv(alpha)
+    except numpy.linalg.LinAlgError:
+        return None, None, -numpy.inf
+    bestflux = numpy.dot(cov, beta)
+
+    if mode == 'marginalise':
+        # integrate the likelihood over the fluxes (flat prior), and record a
+        # draw from their conditional posterior so that the recorded fluxes
+        # sample the full posterior.  The draw is seeded by the parameter
+        # vector so that parallel workers do not share random numbers.
+        sign, logdet = numpy.linalg.slogdet(alpha)
+        lnmarg = 0.5 * nflux * numpy.log(2 * numpy.pi) - 0.5 * logdet
+        seed = hash(pzero.tostring()) % 4294967296
+        draw = numpy.random.RandomState(seed).multivariate_normal( \
+                bestflux, cov)
+        return bestflux, numpy.clip(draw, fluxlo, fluxhi), lnmarg
+
+    # profile likelihood: keep the best-fit fluxes inside the constraints
+    bestflux = numpy.clip(bestflux, fluxlo, fluxhi)
+    return bestflux, bestflux, 0.
+
+# ln of the likelihood ratio between marginalising over an amplitude scale
+# factor g ~ N(1, amperror**2) for each file and fixing g = 1.  With
+# dm = sum(w d m) and mm = sum(w m**2) over the file, the Gaussian integral
+# over g reduces to 0.5 s^2 (dm - mm)^2 / (1 + s^2 mm) - 0.5 ln(1 + s^2 mm).
+def calmarg(real, imag, wgt, model_real, model_imag, filebounds, amperror):
+
+    dm = wgt * (real * model_real + imag * model_imag)
+    mm = wgt * (model_real ** 2 + model_imag ** 2)
+    lncal = 0.
+    for ifile in range(len(filebounds)):
+        start, stop = filebounds[ifile]
+        var = amperror[ifile] ** 2
+        dmsum = dm[start:stop].sum()
+        mmsum = mm[start:stop].sum()
+        lncal += 0.5 * var * (dmsum - mmsum) ** 2 / (1 + var * mmsum) - \
+                0.5 * numpy.log1p(var * mmsum)
+    return lncal
+
+# the model parameters of a full parameter vector: a parameter tied to another
+# one (fixindx >= 0) holds an offset that is added to that parameter's value
+def tieparams(pzero_regions, fixindx):
+
+    fixed = (numpy.where(fixindx >= 0))[0]
+    tiedto = fixindx[fixed].astype(int)
+    parameters_regions = pzero_regions.copy()
+    parameters_regions[fixed] += pzero_regions[tiedto]
+    return parameters_regions
+
+# hold the parameters whose constraints leave them no freedom, such as ones
+# tied to another parameter at a fixed offset, at that value in pfull, and
+# drop them from the sampled indices.  Returns the pinned indices.
+def pinparams(pfull, sampledindx, p_l, p_u):
+
+    pinned = numpy.flatnonzero(p_u == p_l)
+    pfull[pinned] = p_u[pinned]
+    return numpy.setdiff1d(sampledindx, pinned), pinned
+
+# one row of the posterior table: lnprob, every named parameter (the sampled
+# ones from pos, the solved fluxes from the blob and the rest from pfull) and
+# the magnifications in the blob
+def posteriorrow(prob, pos, blob, pfull, sampledindx, fluxindx, nflux):
+
+    fullpos = pfull.copy()
+    fullpos[sampledindx] = pos
+    fullpos[fluxindx[:nflux]] = blob[:nflux]
+    return numpy.concatenate(([prob], fullpos, blob[nflux:]))
 
 # the function that computes the ln-probabilities
-def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
+def lnprob(psampled, pfull, sampledindx, p_u_regions, p_l_regions, fixindx, \
         real, imag, wgt, uuu, vvv, pcd, lnlikemethod, \
         x_regions, y_regions, headmod_regions, celldata, \
-        model_types_regions, nregions, nlens_regions, nsource_regions):
+        model_types_regions, nregions, nlens_regions, nsource_regions, \
+        nsub_regions, nbin_regions, canvas_regions, canvastol, \
+        mergegroups, mergeslices, profileflux, fluxlo, fluxhi, filebounds, \
+        amperror, sbmapopts):
+
+    # expand the sampled parameters to the full parameter vector; the others
+    # (profiled fluxes) keep their placeholder values from pfull
+    t = stagetimer.clock()
+    pzero_regions = pfull.copy()
+    pzero_regions[sampledindx] = psampled
 
     # impose constraints on parameters by setting chi^2 to enormously high
     # value when a walker chooses a parameter outside the constraints
@@ -107,27 +251,26 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
         mu_flux = 0
         #print probln, mu_flux, pzero
         #print probln, ["%0.2f" % i for i in pzero]
+        stagetimer.lap('bounds', t)
         return probln, mu_flux
     if (pzero_regions > p_u_regions).any():
         probln = -numpy.inf
         mu_flux = 0
         #print probln, ["%0.2f" % i for i in pzero]
+        stagetimer.lap('bounds', t)
         return probln, mu_flux
     if (pzero_regions * 0 != 0).any():
         probln = -numpy.inf
         mu_flux = 0
         #print probln, ["%0.2f" % i for i in pzero]
+        stagetimer.lap('bounds', t)
         return probln, mu_flux
 
-    # search poff_models for parameters fixed relative to other parameters
-    fixed = (numpy.where(fixindx >= 0))[0]
-    nfixed = fixindx[fixed].size
-    poff_regions = p_u_regions.copy()
-    poff_regions[:] = 0.
-    for ifix in range(nfixed):
-        poff_regions[fixed[ifix]] = pzero_regions[fixindx[fixed[ifix]]]
+    t = stagetimer.lap('bounds', t)
 
-    parameters_regions = pzero_regions + poff_regions
+    # add the parameters that others are tied to onto their offsets
+    parameters_regions = tieparams(pzero_regions, fixindx)
+    stagetimer.lap('tied', t)
 
     model_real = 0.
     model_imag = 0.
@@ -136,6 +279,14 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
 
     amp = []
 
+    # visibilities of each source at unit flux, and the sums needed for the
+    # region magnifications, when the fluxes are solved for below
+    templates = []
+    ampsums = []
+
+    # shared canvases holding several regions each
+    shared = [numpy.zeros(shape) for headshared, shape, nbin in mergegroups]
+
     for regioni in range(nregions):
 
         # get the model info for this model
@@ -144,6 +295,8 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
         headmod = headmod_regions[regioni]
         nlens = nlens_regions[regioni]
         nsource = nsource_regions[regioni]
+        nsub = nsub_regions[regioni]
+        nbin = nbin_regions[regioni]
         model_types = model_types_regions[prindx:prindx + nsource]
         prindx += nsource
         #model_types_regioni = model_types[regioni]
@@ -153,7 +306,7 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
         nparsource = 6 * nsource
         npar = nparlens + nparsource + npar_previous
         parameters = parameters_regions[npar_previous:npar]
-        npar_previous += npar
+        npar_previous = npar
 
         #-----------------------------------------------------------------
         # Create a surface brightness map of lensed emission for the given set
@@ -161,10 +314,44 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
         #-----------------------------------------------------------------
 
         g_image, g_lensimage, e_image, e_lensimage, amp_tot, amp_mask = \
-                lensutil.sbmap(x, y, nlens, nsource, parameters, model_types)
+                lensutil.sbmap(x, y, nlens, nsource, parameters, model_types, \
+                nsub=nsub, separate=profileflux, **sbmapopts)
         amp.extend(amp_tot)
         amp.extend(amp_mask)
 
+        # observe the smallest preset canvas that holds all but
+        # CanvasTolerance of the lensed flux rendered on the full map
+        crop = slice(None)
+        presets = canvas_regions[regioni]
+        if len(presets) > 0:
+            if profileflux:
+                lensimages = g_lensimage
+            else:
+                lensimages = [g_lensimage]
+            icrop = lensutil.smallestcrop(lensimages, \
+                    [preset[0] for preset in presets], canvastol)
+            if icrop is not None:
+                crop, headmod = presets[icrop]
+
+        # observe each source separately at unit flux
+        if profileflux:
+            if nlens > 0:
+                lensmask = e_lensimage != 0
+                mask = e_image != 0
+                ampsums.append((len(amp), len(templates), \
+                        [image.sum() for image in g_lensimage], \
+                        [image.sum() for image in g_image], \
+                        [image[lensmask].sum() for image in g_lensimage], \
+                        [image[mask].sum() for image in g_image]))
+                amp.extend([0., 0.])
+            for image in g_lensimage:
+                image = image[crop, crop]
+                if nbin > 1:
+                    image = sample_vis.binimage(image, nbin)
+                templates.append(sample_vis.uvmodel(image, headmod, uuu, \
+                        vvv, pcd))
+            continue
+
         #----------------------------------------------------------------------
         # Python version of UVMODEL:
         # "Observe" the lensed emission with the interferometer
@@ -187,7 +374,21 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
             amp.extend([amp_tot])
             amp.extend([amp_mask])
 
-        model_complex = sample_vis.uvmodel(g_image, headmod, uuu, vvv, pcd)
+        # regions on a shared canvas are observed together after the loop
+        if mergeslices[regioni] is not None:
+            groupi, rows, cols = mergeslices[regioni]
+            shared[groupi][rows, cols] += g_lensimage
+            continue
+
+        # integrate the oversampled map down to the FFT cell size
+        g_lensimage = g_lensimage[crop, crop]
+        if nbin > 1:
+            g_lensimage = sample_vis.binimage(g_lensimage, nbin)
+
+        # the model is the lensed map of all the sources, as written out by
+        # plotbestfit.py; without a lens it is the unlensed map
+        model_complex = sample_vis.uvmodel(g_lensimage, headmod, uuu, vvv, \
+                pcd)
         model_real += numpy.real(model_complex)
         model_imag += numpy.imag(model_complex)
 
@@ -198,8 +399,43 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
         #plt.colorbar()
         #plt.show()
 
+    # one FFT and degridding step per shared canvas
+    for groupi in range(len(mergegroups)):
+        headshared, shape, nbin = mergegroups[groupi]
+        g_lensimage = shared[groupi]
+        if nbin > 1:
+            g_lensimage = sample_vis.binimage(g_lensimage, nbin)
+        model_complex = sample_vis.uvmodel(g_lensimage, headshared, uuu, vvv, \
+                pcd)
+        model_real += numpy.real(model_complex)
+        model_imag += numpy.imag(model_complex)
+
+    # solve for the fluxes and build the model from the unit-flux templates
+    t = stagetimer.clock()
+    lnmarg = 0.
+    if profileflux:
+        bestflux, fluxes, lnmarg = fluxsolve(templates, real, imag, wgt, \
+                fluxlo, fluxhi, profileflux, pzero_regions)
+        if fluxes is None:
+            return -numpy.inf, 0
+        for template, flux in zip(templates, bestflux):
+            model_real += flux * numpy.real(template)
+            model_imag += flux * numpy.imag(template)
+
+        # magnifications of each region, weighting the sources by flux
+        for ampindx, fluxstart, lenstot, tot, lensaper, aper in ampsums:
+            fluxr = fluxes[fluxstart:fluxstart + len(tot)]
+            amp_tot = numpy.dot(fluxr, lenstot) / numpy.dot(fluxr, tot)
+            amp_mask = numpy.dot(fluxr, lensaper) / numpy.dot(fluxr, aper)
+            amp[ampindx] = min(amp_tot, 1e2)
+            amp[ampindx + 1] = min(amp_mask, 1e2)
+
+        # the fluxes are returned ahead of the magnifications
+        amp = list(fluxes) + amp
+        t = stagetimer.lap('fluxsolve', t)
+
     # use all visibilities
-    goodvis = (real * 0 == 0)
+    goodvis = numpy.append(real * 0 == 0, imag * 0 == 0)
 
     # calculate chi^2 assuming natural weighting
     #fnuisance = 0.0
@@ -226,22 +462,136 @@ def lnprob(pzero_regions, p_u_regions, p_l_regions, fixindx, \
     #nparam = (pzero != 0).size
     #ndof = nmeasure - nparam
 
+    # marginalise over the amplitude calibration of each file
+    if amperror is not None:
+        lnmarg += calmarg(real, imag, wgt, model_real, model_imag, \
+                filebounds, amperror)
+
     # assert that lnprob is equal to -1 * maximum likelihood estimate
-    probln = -0.5 * lnlike[goodvis].sum()
+    probln = -0.5 * lnlike[goodvis].sum() + lnmarg
     if probln * 0 != 0:
         probln = -numpy.inf
     #print ndof, probln, sigmaterm_all.sum(), chi2_all.sum()
+    stagetimer.lap('chi2', t)
 
     return probln, amp
 
+# lnprob with its blob extended by a snapshot of the stage timers of the
+# process that evaluated it, so that the sampler can combine the timers of all
+# its workers.  The snapshots are cumulative, so the latest one that reaches
+# the sampler in an accepted blob holds every call before it
+def timedlnprob(psampled, *lnprobargs):
+    t = stagetimer.clock()
+    probln, amp = lnprob(psampled, *lnprobargs)
+    stagetimer.lap('lnprob', t)
+    return probln, (amp, stagetimer.snapshot())
+
+# the surrogate lnprob of delayed acceptance, timed as stages of their own
+# (surrogate_lnprob, surrogate_fft2 and so on), so that its cheap calls do not
+# mix with those of the full lnprob
+def timedsurrogate(psampled, *surrogateargs):
+    stagetimer.setprefix('surrogate_')
+    try:
+        t = stagetimer.clock()
+        result = lnprob(psampled, *surrogateargs)
+        stagetimer.lap('lnprob', t)
+    finally:
+        stagetimer.setprefix()
+    return result
+
+# the gradient of lnprob with respect to the sampled parameters, by an adjoint
+# pass: the gradient with respect to the model visibilities is taken back
+# through uvmodel (sample_vis.uvmodeladjoint) and the ray tracing
+# (lensutil.sbmapgrad).  Only Gaussian sources are supported, without
+# AdaptiveOversample, AdaptiveCanvas, MergeRegions, ProfileFlux or AmpCalError.
+def lnprobgrad(psampled, pfull, sampledindx, p_u_regions, p_l_regions, \
+        fixindx, real, imag, wgt, uuu, vvv, pcd, lnlikemethod, \
+        x_regions, y_regions, headmod_regions, celldata, \
+        model_types_regions, nregions, nlens_regions, nsource_regions, \
+        nsub_regions, nbin_regions, canvas_regions, canvastol, \
+        mergegroups, mergeslices, profileflux, fluxlo, fluxhi, filebounds, \
+        amperror, sbmapopts):
+
+    pzero_regions = pfull.copy()
+    pzero_regions[sampledindx] = psampled
+
+    # lnprob is flat (-inf) outside the constraints
+    if (pzero_regions < p_l_regions).any() or \
+            (pzero_regions > p_u_regions).any():
+        return numpy.zeros(psampled.size)
+
+    parameters_regions = tieparams(pzero_regions, fixindx)
+    fixed = (numpy.where(fixindx >= 0))[0]
+    tiedto = fixindx[fixed].astype(int)
+
+    # forward pass, as in lnprob
+    model_real = 0.
+    model_imag = 0.
+    regions = []
+    npar_previous = 0
+    prindx = 0
+    for regioni in range(nregions):
+        nlens = nlens_regions[regioni]
+        nsource = nsource_regions[regioni]
+        model_types = model_types_regions[prindx:prindx + nsource]
+        prindx += nsource
+        npar = 5 * nlens + 6 * nsource + npar_previous
+        parameters = parameters_regions[npar_previous:npar]
+        region = (x_regions[regioni], y_regions[regioni], \
+                headmod_regions[regioni], nbin_regions[regioni], nlens, \
+                nsource, model_types, npar_previous, npar)
+        regions.append(region)
+        npar_previous = npar
+
+        x, y, headmod, nbin = region[:4]
+        g_lensimage = lensutil.sbmap(x, y, nlens, nsource, parameters, \
+                model_types, nsigma=sbmapopts['nsigma'])[1]
+        if nbin > 1:
+            g_lensimage = sample_vis.binimage(g_lensimage, nbin)
+        model_complex = sample_vis.uvmodel(g_lensimage, headmod, uuu, vvv, \
+                pcd)
+        model_real += numpy.real(model_complex)
+        model_imag += numpy.imag(model_complex)
+
+    # gradient of -0.5 chi^2 with respect to the model visibilities
+    gvis = wgt * (real - model_real) + 1j * wgt * (imag - model_imag)
+
+    # adjoint pass, region by region
+    gparams = numpy.zeros(parameters_regions.size)
+    for x, y, headmod, nbin, nlens, nsource, model_types, nstart, nstop \
+            in regions:
+        gmap = sample_vis.uvmodeladjoint(gvis, headmod, uuu, vvv, pcd)
+        if nbin > 1:
+            # every oversampled pixel adds to its binned pixel
+            gmap = numpy.kron(gmap, numpy.ones((nbin, nbin)))
+        gparams[nstart:nstop] = lensutil.sbmapgrad(x, y, nlens, nsource, \
+                parameters_regions[nstart:nstop], model_types, gmap, \
+                nsigma=sbmapopts['nsigma'])
+
+    # a tied parameter also moves with the parameter it is tied to
+    numpy.add.at(gparams, tiedto, gparams[fixed])
+
+    return gparams[sampledindx]
+
+# stop at once on options that cannot work together
+checkoptions(config)
+
 # Determine parallel processing options
 mpi = config.ParallelProcessingMode
 
+# a batch scheduler (see uvbatch.py) assigns the number of threads itself
+nthreadsenv = os.environ.get('UVMCMCFIT_NTHREADS')
+if nthreadsenv is not None:
+    mpi = 'Threads'
+
 # Single processor with Nthreads cores
 if mpi != 'MPI':
 
     # set the number of threads to use for parallel processing
-    Nthreads = config.Nthreads
+    if nthreadsenv is not None:
+        Nthreads = int(nthreadsenv)
+    else:
+        Nthreads = config.Nthreads
 
 # multiple processors on a cluster using MPI
 else:
@@ -278,7 +628,9 @@ vvv = []
 real = []
 imag = []
 wgt = []
-for file in fitsfiles:
+fileid = []
+for ifile in range(nfiles):
+    file = fitsfiles[ifile]
     print file
     vis_data = fits.open(file)
 
@@ -290,6 +642,7 @@ for file in fitsfiles:
     real.extend(real_raw)
     imag.extend(imag_raw)
     wgt.extend(wgt_raw)
+    fileid.extend(numpy.zeros(real_raw.shape, dtype=int) + ifile)
 
 # convert the list to an array
 real = numpy.array(real)
@@ -307,9 +660,35 @@ wgt = wgt[positive_definite]
 uuu = uuu[positive_definite]
 vvv = vvv[positive_definite]
 #www = www[positive_definite]
+fileid = numpy.array(fileid)[positive_definite]
+
+# optionally keep only the short baselines, out to UVMax wavelengths
+uvmax = getattr(config, 'UVMax', None)
+if uvmax is not None:
+    short = numpy.hypot(uuu, vvv) <= uvmax
+    real = real[short]
+    imag = imag[short]
+    wgt = wgt[short]
+    uuu = uuu[short]
+    vvv = vvv[short]
+    fileid = fileid[short]
 
 npos = wgt.size
 
+# the visibilities of each file are contiguous: record where each one starts
+# and stops
+nvis = numpy.bincount(fileid, minlength=nfiles)
+filebounds = numpy.append(0, numpy.cumsum(nvis))
+filebounds = zip(filebounds[:-1], filebounds[1:])
+
+# Optionally marginalise over an independent amplitude scale factor for each
+# file, with a Gaussian prior of mean 1 and this fractional width
+amperror = getattr(config, 'AmpCalError', None)
+if amperror is not None:
+    amperror = numpy.zeros(nfiles) + numpy.array(amperror)
+    if amperror.size != nfiles:
+        raise ValueError('AmpCalError needs one entry per file in FitsFiles')
+
 #----------------------------------------------------------------------------
 # Define the number of walkers
 nwalkers = 32
@@ -322,18 +701,46 @@ nregions = len(regionIDs)
 x = []
 y = []
 modelheader = []
+nsub_regions = []
+nbin_regions = []
+canvas_regions = []
 x_l_off = []
 y_l_off = []
 nlens_regions = []
 nsource_regions = []
 p_u = []
 p_l = []
+pinit_l = []
+pinit_u = []
 poff = []
 pname = []
 pzero = []
 model_types = []
 previousndim_model = 0
 previousnmu = 0
+
+# Optionally ray-trace at the native resolution of the image and use
+# Oversample only to subdivide pixels near critical curves or steep edges
+adaptive = getattr(config, 'AdaptiveOversample', False)
+
+# Optionally block-sum the model map by this factor before the FFT
+binfactor = getattr(config, 'BinFactor', [1] * nregions)
+
+# Optionally observe, for every lnprob call, the smallest of a set of preset
+# canvases that holds all but CanvasTolerance of the rendered lensed flux.
+# The full map is still rendered, and lensed emission reaches its edge (see
+# lensutil.smallestcrop), so this only saves FFTs for unlensed regions.
+adaptivecanvas = getattr(config, 'AdaptiveCanvas', False)
+canvastol = getattr(config, 'CanvasTolerance', 1e-4)
+mincanvas = getattr(config, 'MinCanvas', 32)
+if adaptivecanvas and max(config.Nlens) > 0:
+    print 'AdaptiveCanvas only crops the unlensed regions; lensed regions ' + \
+            'keep their full canvas'
+
+# Optionally solve for the source fluxes inside lnprob instead of sampling
+# them: 'profile' uses the best-fit fluxes, 'marginalise' integrates over them
+profileflux = getattr(config, 'ProfileFlux', False)
+
 for i in range(nregions):
     ri = str(i)
     ra_centroid = config.RACentroid[i]
@@ -347,6 +754,13 @@ for i in range(nregions):
     nlens_regions.append(nlens)
     nsource_regions.append(nsource)
 
+    # Append the sub-pixel refinement factor for this region
+    if adaptive:
+        nsub = oversample
+    else:
+        nsub = 1
+    nsub_regions.append(nsub)
+
     # define number of pixels in lensed surface brightness map
     dx = 2 * extent
     nxmod = oversample * int(round(dx / celldata))
@@ -358,8 +772,20 @@ for i in range(nregions):
     oney = numpy.ones(nymod)
     linspacex = numpy.linspace(0, 1, nxmod)
     linspacey = numpy.linspace(0, 1, nymod)
-    x.append(dx * numpy.outer(oney, linspacex) - extent)
-    y.append(dy * numpy.outer(linspacey, onex) - extent)
+    xmod = dx * numpy.outer(oney, linspacex) - extent
+    ymod = dy * numpy.outer(linspacey, onex) - extent
+
+    # with AdaptiveOversample, ray-trace at the centres of blocks of nsub x
+    # nsub oversampled pixels, so that the sub-pixels of a refined pixel are
+    # the oversampled ones
+    if nsub > 1:
+        nxmod /= nsub
+        nymod /= nsub
+        oversample = 1
+        xmod = xmod.reshape(nymod, nsub, nxmod, nsub).mean(axis=3).mean(axis=1)
+        ymod = ymod.reshape(nymod, nsub, nxmod, nsub).mean(axis=3).mean(axis=1)
+    x.append(xmod)
+    y.append(ymod)
 
     # Provide world-coordinate system transformation data in the header of
     # the lensed surface brightness map
@@ -378,6 +804,33 @@ for i in range(nregions):
     headmod.update('crpix2', crpix2)
     headmod.update('crval2', dec_centroid)
     headmod.update('ctype2', 'DEC--SIN')
+
+    # the FFT is done on the binned map, so give it the binned header
+    nbin = binfactor[i]
+    if nxmod % nbin != 0 or nymod % nbin != 0:
+        raise ValueError('BinFactor for region ' + ri + ' must divide the ' \
+                'model map size of ' + str(nxmod) + ' x ' + str(nymod))
+    nbin_regions.append(nbin)
+
+    # preset canvases, each the central half of the previous one so that the
+    # padded FFT grid halves too
+    presets = []
+    ncanvas = nxmod / 2
+    while adaptivecanvas and ncanvas >= mincanvas and ncanvas % nbin == 0:
+        off = (nxmod - ncanvas) / 2
+        headcanvas = headmod.copy()
+        headcanvas['NAXIS1'] = ncanvas
+        headcanvas['NAXIS2'] = ncanvas
+        headcanvas['CRPIX1'] = crpix1 - off
+        headcanvas['CRPIX2'] = crpix2 - off
+        if nbin > 1:
+            headcanvas = sample_vis.binheader(headcanvas, nbin)
+        presets.insert(0, (slice(off, off + ncanvas), headcanvas))
+        ncanvas /= 2
+    canvas_regions.append(presets)
+
+    if nbin > 1:
+        headmod = sample_vis.binheader(headmod, nbin)
     modelheader.append(headmod)
 
     # the parameter initialization vectors
@@ -446,9 +899,158 @@ for i in range(nregions):
         pzero = pzero_model
     else:
         pzero = numpy.append(pzero, pzero_model, axis=1)
+    pinit_l.extend(p1)
+    pinit_u.extend(p2)
+
+#----------------------------------------------------------------------------
+# Optionally screen proposals with a cheap surrogate lnprob before computing
+# the full one (delayed acceptance).  The surrogate renders each region on a
+# grid SurrogateBin times coarser than the FFT grid, without sub-pixel
+# refinement, preset canvases or shared canvases.
+delayed = getattr(config, 'DelayedAcceptance', False)
+if delayed:
+    surrogatebin = getattr(config, 'SurrogateBin', 2)
+    xsur = []
+    ysur = []
+    headsur = []
+    for i in range(nregions):
+        nymod, nxmod = x[i].shape
+        nbin = nbin_regions[i] * surrogatebin
+        headcoarse = sample_vis.binheader(modelheader[i], surrogatebin)
+        if nxmod % nbin != 0 or nymod % nbin != 0:
+            nbin = nbin_regions[i]
+            headcoarse = modelheader[i]
+
+        # sample the model at the centres of the coarse pixels
+        for grid, coarse in [(x[i], xsur), (y[i], ysur)]:
+            blocks = grid.reshape(nymod / nbin, nbin, nxmod / nbin, nbin)
+            coarse.append(blocks.mean(axis=3).mean(axis=1))
+        headsur.append(headcoarse)
+
+#----------------------------------------------------------------------------
+# plan the shared canvases of MergeRegions.  offx and offy are the offsets of
+# the region centroids from the first one, in arcsec, with x increasing
+# towards the west like the model coordinates; extents are their
+# RadialExtent, step their pixel scales before binning, and nbin and nsub
+# their BinFactor and sub-pixel refinement factor.  Each region joins the
+# first group with the same pixel scale, nbin and nsub whose canvas stays
+# within mergemax pixels.  Returns, for every group of at least two regions,
+# its members, the centre (cx, cy) of its canvas, the number of pixels
+# ncanvas on a side and the coordinates xshared, yshared of the pixels.
+def planmerge(offx, offy, extents, step, nbin, nsub, mergemax):
+
+    # centre and size in pixels of a shared canvas holding the given regions
+    def sharedsize(members):
+        cx = numpy.mean([offx[i] for i in members])
+        cy = numpy.mean([offy[i] for i in members])
+        halfwidth = max([max(numpy.abs(offx[i] - cx), \
+                numpy.abs(offy[i] - cy)) + extents[i] for i in members])
+        nbinj = nbin[members[0]]
+        ncanvas = int(numpy.ceil(2 * halfwidth / step[members[0]])) + 1
+        ncanvas += -ncanvas % (2 * nbinj)
+        return cx, cy, ncanvas
+
+    groups = []
+    for i in range(len(offx)):
+        for members in groups:
+            j = members[0]
+            if nbin[i] != nbin[j] or nsub[i] != nsub[j] or \
+                    numpy.abs(step[i] / step[j] - 1) > 1e-6:
+                continue
+            if sharedsize(members + [i])[2] <= mergemax:
+                members.append(i)
+                break
+        else:
+            groups.append([i])
+
+    plans = []
+    for members in groups:
+        if len(members) < 2:
+            continue
+        cx, cy, ncanvas = sharedsize(members)
+        pixscale = step[members[0]]
+        indx = numpy.arange(ncanvas) - ncanvas / 2
+        xshared = pixscale * numpy.outer(numpy.ones(ncanvas), indx) + cx
+        yshared = pixscale * numpy.outer(indx, numpy.ones(ncanvas)) + cy
+        plans.append((members, cx, cy, ncanvas, xshared, yshared))
+    return plans
+
+# the rows and columns of a shared canvas, with pixel coordinates xshared and
+# yshared and pixel scale pixscale, covered by a region whose centroid is at
+# offx, offy, out to extent
+def mergepatch(xshared, yshared, offx, offy, extent, pixscale):
+    ncanvas = xshared.shape[1]
+    col0 = int(round((offx - extent - xshared[0, 0]) / pixscale))
+    row0 = int(round((offy - extent - yshared[0, 0]) / pixscale))
+    npatch = int(round(2 * extent / pixscale)) + 1
+    cols = slice(max(col0, 0), min(col0 + npatch, ncanvas))
+    rows = slice(max(row0, 0), min(row0 + npatch, ncanvas))
+    return rows, cols
+
+# header of a shared canvas of ncanvas pixels on a side, with pixel scale
+# pixscale, centred cx, cy arcsec from the centroid ra0, dec0 of the first
+# region, binned by nbin
+def mergeheader(headim, ra0, dec0, cx, cy, ncanvas, pixscale, nbin):
+    cosdec0 = numpy.cos(dec0 * numpy.pi / 180)
+    headshared = headim.copy()
+    headshared['NAXIS1'] = ncanvas
+    headshared['CDELT1'] = -1 * pixscale / 3600
+    headshared['CRPIX1'] = ncanvas / 2 + 1
+    headshared['CRVAL1'] = ra0 - cx / 3600 / cosdec0
+    headshared['CTYPE1'] = 'RA---SIN'
+    headshared['NAXIS2'] = ncanvas
+    headshared['CDELT2'] = pixscale / 3600
+    headshared['CRPIX2'] = ncanvas / 2 + 1
+    headshared['CRVAL2'] = dec0 + cy / 3600
+    headshared['CTYPE2'] = 'DEC--SIN'
+    if nbin > 1:
+        headshared = sample_vis.binheader(headshared, nbin)
+    return headshared
+
+# Optionally place nearby regions with the same pixel scale on one shared
+# canvas, so that they need a single FFT and degridding step between them.
+# Each region keeps its own coordinates, measured from its own centroid, on
+# its patch of the shared canvas.
+mergegroups = []
+mergeslices = [None] * nregions
+if getattr(config, 'MergeRegions', False):
+    mergemax = getattr(config, 'MergeMaxSize', 512)
+
+    # offsets of the region centroids from the first one, in arcsec
+    ra0 = config.RACentroid[0]
+    dec0 = config.DecCentroid[0]
+    cosdec0 = numpy.cos(dec0 * numpy.pi / 180)
+    offx = [-(config.RACentroid[i] - ra0) * cosdec0 * 3600 \
+            for i in range(nregions)]
+    offy = [(config.DecCentroid[i] - dec0) * 3600 for i in range(nregions)]
+    step = [numpy.abs(modelheader[i]['CDELT2']) * 3600 / nbin_regions[i] \
+            for i in range(nregions)]
+
+    for members, cx, cy, ncanvas, xshared, yshared in planmerge(offx, offy, \
+            config.RadialExtent, step, nbin_regions, nsub_regions, mergemax):
+        j = members[0]
+        pixscale = step[j]
+        nbin = nbin_regions[j]
+        headshared = mergeheader(headim, ra0, dec0, cx, cy, ncanvas, \
+                pixscale, nbin)
+        groupi = len(mergegroups)
+        mergegroups.append((headshared, (ncanvas, ncanvas), nbin))
+
+        for i in members:
+            # the patch of the shared canvas covered by this region
+            rows, cols = mergepatch(xshared, yshared, offx[i], offy[i], \
+                    config.RadialExtent[i], pixscale)
+            x[i] = xshared[rows, cols] - offx[i]
+            y[i] = yshared[rows, cols] - offy[i]
+            mergeslices[i] = (groupi, rows, cols)
+            canvas_regions[i] = []
+        print 'Regions ' + str(members) + ' share a ' + str(ncanvas) + \
+                ' x ' + str(ncanvas) + ' canvas'
+
+# total number of parameters over all regions
+nparams = len(pname)
 
 # Use an intermediate posterior PDF to initialize the walkers if it exists
-posteriorloc = 'posteriorpdf.hdf5'
 if os.path.exists(posteriorloc):
 
     # read the latest posterior PDFs
@@ -464,6 +1066,13 @@ if os.path.exists(posteriorloc):
             namej = posteriordat.colnames[j + startindx]
             pzero[:, j] = posteriordat[namej][-nwalkers:]
 
+        # the last positions of the previous stage of a ladder (see
+        # uvladder.py) only seed the walkers: their lnprob was computed with
+        # that stage's settings, so they are not kept in this posterior
+        if 'ladderseed' in posteriordat.meta:
+            posteriordat = posteriordat[:0]
+            del posteriordat.meta['ladderseed']
+
         # output name is based on most recent burnin file name
         realpdf = True
     else:
@@ -488,6 +1097,9 @@ if not realpdf:
             nmu += 2
     posteriordat = Table(names = extendedpname)
 
+# each iteration adds one row per walker (see mergepdf.py)
+posteriordat.meta['nwalkers'] = nwalkers
+
 # make sure no parts of pzero exceed p_u or p_l
 arrayp_u = numpy.array(p_u)
 arrayp_l = numpy.array(p_l)
@@ -510,35 +1122,524 @@ for ifix in range(nparams):
 # Determine method of computing lnlike
 lnlikemethod = config.lnLike
 
+# indices of the parameters sampled by emcee; lnprob fills in the others
+sampledindx = numpy.arange(nparams)
+pfull = numpy.zeros(nparams)
+fluxindx = [j for j in range(nparams) if pname[j].startswith('IntrinsicFlux')]
+fluxlo = p_l[fluxindx]
+fluxhi = p_u[fluxindx]
+if profileflux:
+    for j in fluxindx:
+        if fixindx[j] >= 0 or (fixindx == j).any():
+            raise ValueError('ProfileFlux does not support tied fluxes: ' + \
+                    pname[j])
+    sampledindx = numpy.setdiff1d(sampledindx, fluxindx)
+
+    # the fluxes are solved for at unit-flux placeholders, unconstrained
+    pfull[fluxindx] = 1.
+    p_u = p_u.copy()
+    p_l = p_l.copy()
+    p_u[fluxindx] = numpy.inf
+    p_l[fluxindx] = -numpy.inf
+    print 'Solving for ' + str(len(fluxindx)) + ' source fluxes (' + \
+            profileflux + ')'
+
+# parameters whose constraints leave them no freedom, such as ones tied to
+# another parameter at a fixed offset, are held at that value, not sampled
+sampledindx, pinned = pinparams(pfull, sampledindx, p_l, p_u)
+if pinned.size > 0:
+    print 'Holding ' + str(pinned.size) + ' parameters fixed: ' + \
+            str([pname[j] for j in pinned])
+nsampled = sampledindx.size
+pzero = pzero[:, sampledindx]
+
+# Rendering options passed through to lensutil.sbmap
+sbmapopts = {}
+
+# Optionally render sources only within this many sigma of their centers
+sbmapopts['nsigma'] = getattr(config, 'SourceFootprint', None)
+
+# Thresholds for adaptive sub-pixel refinement
+if adaptive:
+    sbmapopts['muthresh'] = getattr(config, 'AdaptiveMagnification', 10.)
+    sbmapopts['gradthresh'] = getattr(config, 'AdaptiveGradient', 0.1)
+    sbmapopts['sizethresh'] = getattr(config, 'AdaptiveSize', 0.35)
+
+# the arguments passed to lnprob after the parameter vector
+lnprobargs = [pfull, sampledindx, p_u, p_l, fixindx, real, imag, wgt, uuu, \
+        vvv, pcd, lnlikemethod, x, y, modelheader, celldata, model_types, \
+        nregions, nlens_regions, nsource_regions, nsub_regions, \
+        nbin_regions, canvas_regions, canvastol, mergegroups, mergeslices, \
+        profileflux, fluxlo, fluxhi, filebounds, amperror, sbmapopts]
+
+# the surrogate arguments, optionally fitting a random SurrogateFraction of the
+# visibilities with their weights scaled up to match the full data set
+if delayed:
+    surrogatefrac = getattr(config, 'SurrogateFraction', 1.)
+    surrogateindx = numpy.arange(npos)
+    if surrogatefrac < 1:
+        nsurrogate = int(round(surrogatefrac * npos))
+        surrogateindx = numpy.sort(numpy.random.permutation(npos)[:nsurrogate])
+    nvissur = numpy.bincount(fileid[surrogateindx], minlength=nfiles)
+    boundsur = numpy.append(0, numpy.cumsum(nvissur))
+    boundsur = zip(boundsur[:-1], boundsur[1:])
+    wgtsur = wgt[surrogateindx] * npos / float(surrogateindx.size)
+    surrogateargs = [pfull, sampledindx, p_u, p_l, fixindx, \
+            real[surrogateindx], imag[surrogateindx], wgtsur, \
+            uuu[surrogateindx], vvv[surrogateindx], pcd, lnlikemethod, \
+            xsur, ysur, headsur, celldata, model_types, nregions, \
+            nlens_regions, nsource_regions, [1] * nregions, [1] * nregions, \
+            [[]] * nregions, canvastol, [], [None] * nregions, profileflux, \
+            fluxlo, fluxhi, boundsur, amperror, sbmapopts]
+
+#----------------------------------------------------------------------------
+# Estimate the memory each worker needs: the data and coordinate grids it
+# holds throughout, and the largest set of arrays one lnprob call holds at
+# once (rendering one region, its FFT canvas and degridding, then the chi^2).
+# Stop before sampling if the total over the workers exceeds MemoryBudget MB.
+# Forked workers share the pages of the data until they write to them, so the
+# total is an upper bound.  The per-visibility and per-pixel costs were
+# measured with numpy 1.16 as the rise in peak resident memory over a call.
+MB = 1024. ** 2
+baselinebytes = importrss * MB
+visbytes = sum([vis.nbytes for vis in [real, imag, wgt, uuu, vvv]])
+# the model, its variances, the chi^2 and sigma terms of the real and imaginary
+# halves and the mask: 122 bytes a visibility for lnLike = 'chi2' and 138 with
+# the sigma terms
+chi2bytes = 144 * npos
+print 'Memory plan per worker: ' + str(importrss) + ' MB for Python ' + \
+        'and the modules, ' + str(visbytes / MB) + \
+        ' MB of visibilities, ' + str(chi2bytes / MB) + ' MB for the chi^2'
+fftbytes = [sample_vis.uvmodelbytes(modelheader[i], npos) \
+        for i in range(nregions)]
+for headshared, shape, nbin in mergegroups:
+    fftbytes.append(sample_vis.uvmodelbytes(headshared, npos))
+gridbytes = 0
+callbytes = 0
+for i in range(nregions):
+    regiongrid = x[i].nbytes + y[i].nbytes
+    gridbytes += regiongrid
+    # sbmap peaks at 107 bytes a pixel with one lens and a Gaussian source,
+    # and 132 with two or three lenses
+    renderbytes = 160 * x[i].size
+    canvasbytes, degridbytes = fftbytes[i]
+    callbytes = max(callbytes, renderbytes + canvasbytes + degridbytes)
+    print 'Region ' + str(i) + ': ' + str(regiongrid / MB) + \
+            ' MB of coordinate grids, ' + str(renderbytes / MB) + \
+            ' MB rendering, ' + str(canvasbytes / MB) + ' MB FFT canvas, ' + \
+            str(degridbytes / MB) + ' MB degridding'
+for canvasbytes, degridbytes in fftbytes[nregions:]:
+    callbytes = max(callbytes, canvasbytes + degridbytes)
+if profileflux:
+    callbytes += 16 * npos * sum(nsource_regions)
+if mpi == 'MPI':
+    nworkers = pool.size
+else:
+    nworkers = max(Nthreads, 1)
+workerbytes = baselinebytes + visbytes + gridbytes + callbytes + chi2bytes
+print 'Estimated memory: ' + str(workerbytes / MB) + ' MB per worker, ' + \
+        str(nworkers * workerbytes / MB) + ' MB for ' + str(nworkers) + \
+        ' workers'
+memorybudget = getattr(config, 'MemoryBudget', None)
+if memorybudget is not None and nworkers * workerbytes / MB > memorybudget:
+    raise ValueError('The estimated memory of ' + \
+            str(nworkers * workerbytes / MB) + ' MB exceeds MemoryBudget (' + \
+            str(memorybudget) + ' MB); reduce Oversample, RadialExtent, ' + \
+            'Nthreads or the number of visibilities')
+
+#----------------------------------------------------------------------------
+# When run by uvreplay.py, evaluate lnprob again, single-threaded and under
+# cProfile, at the parameter vectors recorded by an earlier run (see
+# RecordCalls), compare with the recorded values and exit
+replayloc = os.environ.get('UVMCMCFIT_REPLAY')
+if replayloc is not None:
+    recording = hdf5.read_table_hdf5(replayloc)
+    if recording.meta['datahash'] != mcmcutil.datahash(lnprobargs):
+        sys.exit('The data or settings differ from those of the recording ' + \
+                replayloc)
+    names = [pname[j] for j in sampledindx]
+    points = numpy.array([recording[name] for name in names]).T
+    print 'Replaying ' + str(len(points)) + ' lnprob calls from ' + replayloc
+    profiler = cProfile.Profile()
+    replayed, percall = profiler.runcall(mcmcutil.replay, lnprob, \
+            lnprobargs, points)
+    profiler.dump_stats('lnprobreplay.prof')
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    print str(percall) + ' s per lnprob call; profile in lnprobreplay.prof'
+
+    # bit for bit when UVMCMCFIT_REPLAYTOL is 0, otherwise to that relative
+    # tolerance; proposals outside the constraints replay as -inf
+    rtol = float(os.environ.get('UVMCMCFIT_REPLAYTOL', 0))
+    recorded = numpy.array(recording['lnprob'])
+    with numpy.errstate(invalid='ignore'):
+        same = (replayed == recorded) | \
+                (numpy.abs(replayed - recorded) <= rtol * numpy.abs(recorded))
+        diff = numpy.abs(replayed - recorded)
+    diff = diff[numpy.isfinite(diff)]
+    if diff.size > 0:
+        print 'Largest difference in lnprob: ' + str(diff.max())
+    if not same.all():
+        sys.exit(str((~same).sum()) + ' of ' + str(same.size) + \
+                ' lnprob values differ from the recording')
+    print 'All ' + str(same.size) + ' lnprob values match the recording'
+    sys.exit(0)
+
+# When run by uvbenchmark.py, time UVMCMCFIT_BENCHMARK lnprob calls at the
+# starting positions of the walkers, after one call to fill the caches, write
+# the results to benchmark.json and exit
+benchcalls = os.environ.get('UVMCMCFIT_BENCHMARK')
+if benchcalls is not None:
+    startup = time.time() - runstart
+    points = pzero[numpy.arange(int(benchcalls) + 1) % nwalkers]
+    firstlnp, firstcall = mcmcutil.replay(lnprob, lnprobargs, points[:1])
+    lnp, percall = mcmcutil.replay(lnprob, lnprobargs, points[1:])
+
+    # the cost of sending the lnprob arguments to a worker process, which a
+    # multiprocessing pool pays for every batch of walkers it hands out
+    start = time.time()
+    pickled = cPickle.dumps(lnprobargs, cPickle.HIGHEST_PROTOCOL)
+    cPickle.loads(pickled)
+    pickletime = time.time() - start
+    benchmark = {'startup': startup, 'firstcall': firstcall, \
+            'percall': percall, 'lnprobrate': 1. / percall, \
+            'calls': len(lnp), 'finite': int(numpy.isfinite(lnp).sum()), \
+            'nvis': int(npos), 'nparams': int(nsampled), \
+            'peakmemory': mcmcutil.peakrss(), \
+            'estimatedmemory': workerbytes / MB, \
+            'pickletime': pickletime, 'picklebytes': len(pickled)}
+    benchmarkfile = open('benchmark.json', 'w')
+    json.dump(benchmark, benchmarkfile, indent=1, sort_keys=True)
+    benchmarkfile.close()
+    print str(benchmark['lnprobrate']) + ' lnprob calls per second'
+    sys.exit(0)
+
+#----------------------------------------------------------------------------
+# Optionally run MultiStart local optimisations of lnprob from random
+# positions in the Init boxes, and start the walkers in a small ball around
+# the best mode found instead of throughout the boxes.
+nstart = getattr(config, 'MultiStart', 0)
+if nstart > 0 and not realpdf:
+    pinit_l = numpy.array(pinit_l)[sampledindx]
+    pinit_u = numpy.array(pinit_u)[sampledindx]
+    initwidth = pinit_u - pinit_l
+
+    # a parameter whose Init box has no width still needs a simplex step and
+    # a ball around the optimum, so it gets a small absolute width
+    initwidth[initwidth <= 0] = getattr(config, 'MultiStartMinWidth', 1e-3)
+    starts = numpy.random.uniform(pinit_l, pinit_u, (nstart, nsampled))
+    maxiter = getattr(config, 'MultiStartIter', 200 * nsampled)
+    optargs = [(lnprob, start, 0.1 * initwidth, lnprobargs, maxiter) \
+            for start in starts]
+    print 'Running ' + str(nstart) + ' optimisations of lnprob'
+    if mpi == 'MPI':
+        optima = pool.map(mcmcutil.optimize, optargs)
+    elif Nthreads > 1:
+        optpool = multiprocessing.Pool(Nthreads)
+        optima = optpool.map(mcmcutil.optimize, optargs)
+        optpool.close()
+    else:
+        optima = map(mcmcutil.optimize, optargs)
+    optpos = numpy.array([pbest for pbest, lnpbest in optima])
+    optlnp = numpy.array([lnpbest for pbest, lnpbest in optima])
+
+    # walkers start around the best point of the best mode
+    modes = mcmcutil.clustermodes(optpos, optlnp, initwidth)
+    for mode in modes:
+        print 'Mode with ' + str(len(mode)) + ' optima: lnprob = ' + \
+                str(optlnp[mode[0]])
+    ballwidth = getattr(config, 'MultiStartBall', 1e-3)
+    pzero = mcmcutil.ball(optpos[modes[0][0]], ballwidth * initwidth, \
+            nwalkers, p_l[sampledindx], p_u[sampledindx])
+
+#----------------------------------------------------------------------------
+# Optionally burn in with TemperedBurnin iterations of parallel tempering,
+# running the walkers at Temperatures temperatures (up to TemperedTmax) with
+# swaps between them, so that they can cross between well-separated modes.
+# The cold chain then starts the normal sampling.
+ntempered = getattr(config, 'TemperedBurnin', 0)
+if ntempered > 0 and not realpdf:
+    ntemps = getattr(config, 'Temperatures', 8)
+    tmax = getattr(config, 'TemperedTmax', None)
+    ptargs = dict(loglargs=[lnprob] + lnprobargs, \
+            logpargs=[p_l[sampledindx], p_u[sampledindx]], Tmax=tmax)
+    if mpi == 'MPI':
+        ptsampler = emcee.PTSampler(ntemps, nwalkers, nsampled, \
+                mcmcutil.lnlikeonly, mcmcutil.boxprior, pool=pool, **ptargs)
+    else:
+        ptsampler = emcee.PTSampler(ntemps, nwalkers, nsampled, \
+                mcmcutil.lnlikeonly, mcmcutil.boxprior, threads=Nthreads, \
+                **ptargs)
+    print 'Tempered burn-in: ' + str(ntempered) + ' iterations at ' + \
+            str(ntemps) + ' temperatures ' + str(1. / ptsampler.betas)
+    ptpos = numpy.array([pzero] * ntemps)
+    iteration = 0
+    for ptpos, ptlnprob, ptlnlike in ptsampler.sample(ptpos, \
+            iterations=ntempered, storechain=False):
+        iteration += 1
+        if iteration % 100 == 0 or iteration == ntempered:
+            print 'Tempered iteration ' + str(iteration) + ': cold lnprob ' \
+                    + str(ptlnprob[0].max()) + ', swap acceptance ' + \
+                    str(ptsampler.tswap_acceptance_fraction)
+    pzero = ptpos[0].copy()
+    if mpi != 'MPI' and ptsampler.pool is not None:
+        ptsampler.pool.close()
+
+#----------------------------------------------------------------------------
+# Optionally check the analytic lnprob gradient against central differences
+# at the first walker's starting position
+if getattr(config, 'CheckGradient', False):
+    unsupported = [option for option in ['AdaptiveOversample', \
+            'AdaptiveCanvas', 'MergeRegions', 'ProfileFlux', 'AmpCalError'] \
+            if getattr(config, option, False)]
+    if len(unsupported) > 0 or 'cylinder' in model_types:
+        raise ValueError('lnprobgrad does not support cylinder sources or ' \
+                + str(unsupported))
+    pcheck = pzero[0]
+    gradient = lnprobgrad(pcheck, *lnprobargs)
+    for j in range(nsampled):
+        h = 1e-5 * max(numpy.abs(pcheck[j]), 1.)
+        phi = pcheck.copy()
+        phi[j] += h
+        plo = pcheck.copy()
+        plo[j] -= h
+        numeric = (lnprob(phi, *lnprobargs)[0] - \
+                lnprob(plo, *lnprobargs)[0]) / (2 * h)
+        print pname[sampledindx[j]] + ': analytic ' + str(gradient[j]) + \
+                ', numerical ' + str(numeric)
+
+# with TimeStages, the blobs also carry the stage timers of the workers
+if timestages:
+    lnprobfn = timedlnprob
+    surrogatefn = timedsurrogate
+else:
+    lnprobfn = lnprob
+    surrogatefn = lnprob
+timers = {}
+timing = {}
+
 # Initialize the sampler with the chosen specs.
-if mpi != 'MPI':
+if delayed and mpi != 'MPI':
+    sampler = mcmcutil.DelayedSampler(nwalkers, nsampled, lnprobfn, \
+        surrogatefn, surrogateargs, args=lnprobargs, threads=Nthreads)
+elif delayed:
+    sampler = mcmcutil.DelayedSampler(nwalkers, nsampled, lnprobfn, \
+        surrogatefn, surrogateargs, args=lnprobargs, pool=pool)
+elif mpi != 'MPI':
     # Single processor with Nthreads cores
-    sampler = emcee.EnsembleSampler(nwalkers, nparams, lnprob, \
-        args=[p_u, p_l, fixindx, real, imag, wgt, uuu, vvv, pcd, \
-        lnlikemethod, x, y, modelheader, celldata, model_types, nregions, \
-        nlens_regions, nsource_regions], threads=Nthreads)
+    sampler = emcee.EnsembleSampler(nwalkers, nsampled, lnprobfn, \
+        args=lnprobargs, threads=Nthreads)
 else:
     # Multiple processors using MPI
-    sampler = emcee.EnsembleSampler(nwalkers, nparams, lnprob, pool=pool, \
-        args=[p_u, p_l, fixindx, real, imag, wgt, uuu, vvv, pcd, \
-        lnlikemethod, x, y, modelheader, celldata, model_types, nregions, \
-        nlens_regions, nsource_regions])
+    sampler = emcee.EnsembleSampler(nwalkers, nsampled, lnprobfn, \
+        pool=pool, args=lnprobargs)
 
-# Sample, outputting to a file
-os.system('date')
-
-for pos, prob, state, amp in sampler.sample(pzero, iterations=10000):
+# number of solved-for fluxes and of magnifications in the lnprob blobs
+if profileflux:
+    nflux = len(fluxindx)
+else:
+    nflux = 0
+namp = len(posteriordat.colnames) - 1 - nparams
+
+# Sample for at most Iterations steps, stopping early once the median lnprob
+# of the walkers has improved by less than PlateauTolerance over the last
+# PlateauIterations steps
+niterations = getattr(config, 'Iterations', 10000)
+plateauiter = getattr(config, 'PlateauIterations', 0)
+plateautol = getattr(config, 'PlateauTolerance', 1.)
+medlnprob = []
+
+# Optionally stop once the chain holds EffectiveSamples independent samples,
+# estimated from the integrated autocorrelation times every AutocorrInterval
+# iterations.  The first half of the chain is discarded as burn-in, and the
+# estimate is only trusted once that half is AutocorrTrust times longer than
+# the longest autocorrelation time.
+neffective = getattr(config, 'EffectiveSamples', None)
+autocorrinterval = getattr(config, 'AutocorrInterval', 100)
+autocorrtrust = getattr(config, 'AutocorrTrust', 50)
+
+# Optionally, during the first ReseedWalkers iterations, check the walkers
+# every ReseedInterval iterations and move those that are stuck (acceptance
+# below ReseedAcceptance over the interval, or lnprob more than ReseedLnprob
+# below the median) next to a randomly chosen healthy walker
+nreseed = getattr(config, 'ReseedWalkers', 0)
+reseedinterval = getattr(config, 'ReseedInterval', 100)
+reseedacc = getattr(config, 'ReseedAcceptance', 0.02)
+reseedlnprob = getattr(config, 'ReseedLnprob', 50.)
+lastaccepted = numpy.zeros(nwalkers)
+
+# Optionally keep a uniform random sample of RecordCalls of the positions
+# evaluated by lnprob during the run (every proposal, accepted or not), for
+# uvreplay.py
+nrecord = getattr(config, 'RecordCalls', 0)
+recordloc = 'lnprobcalls.hdf5'
+if nrecord > 0:
+    recorder = mcmcutil.CallRecorder(sampler, nrecord, \
+            numpy.random.RandomState(seed))
+
+# Optionally stop before a wall-clock budget of WallTime seconds (counted
+# from the start of the run) runs out, leaving WallTimeMargin seconds spare
+walltime = getattr(config, 'WallTime', None)
+walltimemargin = getattr(config, 'WallTimeMargin', 60.)
+
+# Report the progress to progress.json every ProgressInterval seconds
+# (default 10; None for no file) and, if ProgressPort is set, over HTTP on
+# localhost:ProgressPort
+progressinterval = getattr(config, 'ProgressInterval', 10.)
+if progressinterval is None:
+    progressloc = None
+progress = mcmcutil.ProgressMonitor(progressloc, interval=progressinterval, \
+        port=getattr(config, 'ProgressPort', None))
+bestlnprob = -numpy.inf
+stopreason = 'finished ' + str(niterations) + ' iterations'
 
-    print numpy.mean(sampler.acceptance_fraction)
-    print os.system('date')
-    #ff.write(str(prob))
-    yesamp = amp > 0
-    namp = len(amp[yesamp])
-    superpos = numpy.zeros(1 + nparams + namp)
+# Sample, outputting to a file
+print 'Sampling started ' + time.ctime()
+starttime = time.time()
+itertime = starttime
+itertimes = []
+iteration = 0
+
+for pos, prob, state, amp in sampler.sample(pzero, iterations=niterations):
+    iteration += 1
+
+    acceptance = numpy.mean(sampler.acceptance_fraction)
+    bestlnprob = max(bestlnprob, numpy.max(prob))
+    if delayed:
+        nevaluations = sampler.nfull
+    else:
+        nevaluations = nwalkers * iteration
+    elapsed = time.time() - starttime
+
+    # combine the stage timers returned by the workers
+    if timestages:
+        for wi in range(nwalkers):
+            stagetimer.collect(timers, amp[wi][1])
+        timing = stagetimer.total(timers)
+        for stage in timing:
+            posteriordat.meta['timing_' + stage] = timing[stage]
+        posteriordat.meta['timing_bins'] = stagetimer.histedges
+
+    print 'Iteration ' + str(iteration) + ': acceptance ' + \
+            str(acceptance) + ', best lnprob ' + str(bestlnprob) + ', ' + \
+            str(elapsed / iteration) + ' s per iteration'
+    if delayed:
+        print 'Full lnprob evaluations: ' + str(sampler.nfull) + ' of ' + \
+                str(sampler.nscreened) + ' proposals'
+    recent = itertimes[-10:] + [time.time() - itertime]
+    workermemory = dict([(str(pid), mcmcutil.peakrss(pid)) \
+            for pid in mcmcutil.workerpids(sampler.pool)])
+    progress.update(state='sampling', iteration=iteration, \
+            iterations=niterations, elapsed=elapsed, \
+            iterationrate=iteration / elapsed, \
+            lnprobrate=nevaluations / elapsed, acceptance=float(acceptance), \
+            medianlnprob=float(numpy.median(prob)), \
+            bestlnprob=float(bestlnprob), \
+            eta=(niterations - iteration) * numpy.mean(recent), \
+            timing=stagetimer.summary(timing), workermemory=workermemory)
+    blob = numpy.zeros(nflux + namp)
     for wi in range(nwalkers):
-        superpos[0] = prob[wi]
-        superpos[1:nparams + 1] = pos[wi]
-        superpos[nparams + 1:nparams + namp + 1] = amp[wi]
-        posteriordat.add_row(superpos)
-    hdf5.write_table_hdf5(posteriordat, 'posteriorpdf.hdf5', 
+        # a rejected starting position has a blob of 0
+        if timestages:
+            blob[:] = amp[wi][0]
+        else:
+            blob[:] = amp[wi]
+        posteriordat.add_row(posteriorrow(prob[wi], pos[wi], blob, pfull, \
+                sampledindx, fluxindx, nflux))
+
+    # the blobs are in the posterior now, and the stage timers collected;
+    # emcee would otherwise keep the blobs of every iteration in memory, with
+    # a snapshot of the timers in each (some 7 kB) under TimeStages
+    sampler.clear_blobs()
+
+    # write to a temporary file first, so that a run killed mid-write leaves
+    # the previous posterior intact
+    hdf5.write_table_hdf5(posteriordat, posteriorloc + '.tmp', 
             path = '/posteriorpdf', overwrite=True, compression=True)
+    os.rename(posteriorloc + '.tmp', posteriorloc)
+
+    # stop cleanly if the next iteration might not finish within WallTime
+    itertimes.append(time.time() - itertime)
+    itertime = time.time()
+    if walltime is not None:
+        remaining = walltime - (itertime - runstart) - walltimemargin
+        if remaining < 2 * max(itertimes[-10:]):
+            print 'Stopping with ' + str(remaining) + \
+                    ' s of WallTime left; resume from ' + posteriorloc
+            stopreason = 'out of WallTime'
+            break
+
+    medlnprob.append(numpy.median(prob))
+    if plateauiter > 0 and mcmcutil.plateau(medlnprob, plateauiter, \
+            plateautol):
+        print 'Median lnprob has reached a plateau; stopping'
+        stopreason = 'plateau'
+        break
+
+    if iteration <= nreseed and iteration % reseedinterval == 0:
+        # emcee's sample() yields its own arrays, so the walkers are moved by
+        # changing pos, prob and amp in place
+        accepted = (sampler.naccepted - lastaccepted) / reseedinterval
+        lastaccepted = sampler.naccepted.copy()
+        stuck, healthy = mcmcutil.stuckwalkers(prob, accepted, reseedacc, \
+                reseedlnprob)
+        if len(healthy) == 0:
+            stuck = []
+        else:
+            spread = pos[healthy].std(axis=0)
+        for wi in stuck:
+            wj = healthy[numpy.random.randint(len(healthy))]
+            newpos = pos[wj] + 1e-2 * spread * \
+                    numpy.random.normal(size=nsampled)
+            newprob, newamp = lnprobfn(newpos, *lnprobargs)
+            if newprob * 0 != 0:
+                newpos, newprob, newamp = pos[wj].copy(), prob[wj], amp[wj]
+            print 'Reseeding walker ' + str(wi) + ' (lnprob ' + \
+                    str(prob[wi]) + ', acceptance ' + str(accepted[wi]) + \
+                    ') next to walker ' + str(wj) + ' (lnprob ' + \
+                    str(newprob) + ')'
+            pos[wi] = newpos
+            prob[wi] = newprob
+            amp[wi] = newamp
+
+    if iteration % autocorrinterval == 0:
+        chain = sampler.chain[:, iteration / 2:iteration, :]
+        tau = mcmcutil.autocorrtime(chain)
+        jmax = numpy.argmax(tau)
+        neff = nwalkers * chain.shape[1] / tau[jmax]
+        print 'Longest autocorrelation time: ' + str(tau[jmax]) + \
+                ' iterations (' + pname[sampledindx[jmax]] + ')'
+        print 'Effective samples: ' + str(neff) + ' (' + \
+                str(neff / (time.time() - starttime)) + ' per second)'
+        if neffective is not None and neff >= neffective and \
+                chain.shape[1] >= autocorrtrust * tau[jmax]:
+            print 'Reached ' + str(neffective) + ' effective samples; stopping'
+            stopreason = 'effective samples'
+            break
+
+elapsed = time.time() - starttime
+status = dict(progress.status)
+status.update(state='done: ' + stopreason, elapsed=elapsed, eta=0.)
+progress.update(force=True, **status)
+progress.close()
+
+# save the recorded lnprob calls with the identity of the data they were
+# evaluated on
+if nrecord > 0 and len(recorder.sample) > 0:
+    names = ['lnprob'] + [pname[j] for j in sampledindx]
+    recording = Table(rows=[[lnp] + list(p) for lnp, p in recorder.sample], \
+            names=names)
+    recording.meta['datahash'] = mcmcutil.datahash(lnprobargs)
+    hdf5.write_table_hdf5(recording, recordloc, path='/lnprobcalls', \
+            overwrite=True)
+    print 'Recorded ' + str(len(recorder.sample)) + ' of ' + \
+            str(recorder.ncalls) + ' lnprob calls in ' + recordloc
+print 'Peak memory: ' + str(mcmcutil.peakrss()) + ' MB in the main process' + \
+        ''.join([', ' + str(status['workermemory'][pid]) + ' MB in worker ' + \
+        pid for pid in sorted(status.get('workermemory', {}))]) + \
+        ' (estimated ' + str(workerbytes / MB) + ' MB per worker)'
+if mpi == 'MPI':
+    print 'Under MPI only the main process is measured'
+
+# release the MPI workers
+if mpi == 'MPI':
+    pool.close()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Evaluate lnprob again at the parameter vectors recorded during a uvmcmcfit
+run, to profile the likelihood and check changes to it on real inputs
+without running the MCMC.
+
+USAGE
+
+ Set RecordCalls in config.py (e.g. RecordCalls = 200) for a normal run; it
+ keeps a random sample of that many of the positions evaluated by lnprob,
+ with their lnprob values and a digest of the data and settings, in
+ lnprobcalls.hdf5.  Then, in the same directory, run
+
+ python $PYSRC/uvreplay.py [rtol] [recording]
+
+ uvmcmcfit reads and prepares the data as usual, checks that it matches the
+ digest in the recording (default lnprobcalls.hdf5), and evaluates lnprob at
+ every recorded position in one process under cProfile.  It prints the
+ 20 most expensive functions, writes the full profile to lnprobreplay.prof,
+ and compares every lnprob value with the recorded one: bit for bit by
+ default, or to the relative tolerance rtol.  The exit status is 1 if any
+ value differs.
+"""
+
+import os
+import sys
+import subprocess
+
+
+uvmcmcfitloc = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        'uvmcmcfit.py')
+
+if len(sys.argv) > 1:
+    rtol = sys.argv[1]
+else:
+    rtol = '0'
+if len(sys.argv) > 2:
+    replayloc = sys.argv[2]
+else:
+    replayloc = 'lnprobcalls.hdf5'
+
+env = os.environ.copy()
+env['UVMCMCFIT_REPLAY'] = os.path.abspath(replayloc)
+env['UVMCMCFIT_REPLAYTOL'] = rtol
+env['UVMCMCFIT_NTHREADS'] = '1'
+sys.exit(subprocess.call([sys.executable, uvmcmcfitloc], env=env))
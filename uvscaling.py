@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Parallel scaling benchmark of uvmcmcfit on this machine.
+
+USAGE
+
+ python $PYSRC/uvscaling.py [maxworkers] [iterations] [results]
+
+ A fixed synthetic problem (see synthetic.py) is written to uvscaling/ and
+ sampled for iterations (default 10) MCMC iterations with every available
+ parallel backend at 1, 2, 4, ... up to maxworkers workers (default the
+ number of cores, at most 16, half the walkers, which is as many as emcee
+ evaluates at once):
+
+ - Threads: a multiprocessing pool of Nthreads processes on this node
+   (Nthreads = 1 is the serial run every speedup is measured against)
+ - MPI: ParallelProcessingMode = 'MPI' with local ranks started by mpirun,
+   one master and the workers, if mpirun and mpi4py are both available
+
+ For each run the seconds per iteration, the speedup and the parallel
+ efficiency (speedup per worker), the overhead beyond ideal scaling, the
+ part of it spent pickling the lnprob arguments (which a multiprocessing
+ pool sends with every batch of walkers, but MPI only once), and the peak
+ memory per worker are printed and written, with the serial cost of one
+ lnprob call, to the JSON file results (default uvscaling.json).  Finally
+ the fastest setting is recommended, or one with fewer workers if it is
+ within 5% of the fastest.  Only the master of an MPI run can be measured
+ for memory.
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import platform
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+import numpy
+import synthetic
+
+uvmcmcfitloc = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        'uvmcmcfit.py')
+
+nwalkers = 32
+setup = {'telescope': 'ALMA', 'nvis': 20000, 'nchan': 1, 'npol': 2, \
+        'nspw': 1, 'extent': 2., 'oversample': 2, 'nlens': 1, 'nsource': 1}
+rundir = 'uvscaling'
+
+# the fraction of the fastest time per iteration within which fewer workers
+# are preferred
+tolerance = 0.05
+
+
+# True if uvmcmcfit can run with local MPI ranks
+def haveMPI():
+    if find_executable('mpirun') is None:
+        return False
+    try:
+        import mpi4py
+    except ImportError:
+        return False
+    return True
+
+# run uvmcmcfit on the synthetic problem with one backend and number of
+# workers, and return its status from progress.json
+def runbackend(backend, nworkers, niterations):
+    extra = ['Iterations = ' + str(niterations), 'ProgressInterval = 0', \
+            'Seed = 1']
+    env = os.environ.copy()
+    env.pop('UVMCMCFIT_NTHREADS', None)
+    if backend == 'MPI':
+        extra.append("ParallelProcessingMode = 'MPI'")
+        command = ['mpirun', '-np', str(nworkers + 1), sys.executable, \
+                uvmcmcfitloc]
+    else:
+        env['UVMCMCFIT_NTHREADS'] = str(nworkers)
+        command = [sys.executable, uvmcmcfitloc]
+    synthetic.writefit(rundir, setup, numpy.random.RandomState(1), extra)
+
+    log = open(os.path.join(rundir, 'uvmcmcfit.log'), 'w')
+    status = subprocess.call(command, cwd=rundir, env=env, stdout=log, \
+            stderr=subprocess.STDOUT)
+    log.close()
+    progressloc = os.path.join(rundir, 'progress.json')
+    if status != 0 or not os.path.exists(progressloc):
+        return None
+    return json.load(open(progressloc))
+
+# the serial cost of one lnprob call and of pickling its arguments
+def runserial():
+    synthetic.writefit(rundir, setup, numpy.random.RandomState(1))
+    env = os.environ.copy()
+    env['UVMCMCFIT_BENCHMARK'] = str(nwalkers)
+    env['UVMCMCFIT_NTHREADS'] = '1'
+    log = open(os.path.join(rundir, 'uvmcmcfit.log'), 'w')
+    status = subprocess.call([sys.executable, uvmcmcfitloc], cwd=rundir, \
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    if status != 0:
+        sys.exit('uvmcmcfit failed, see ' + \
+                os.path.join(rundir, 'uvmcmcfit.log'))
+    return json.load(open(os.path.join(rundir, 'benchmark.json')))
+
+# number of batches of walkers a multiprocessing pool of nworkers hands out
+# per iteration: two half-steps of nwalkers / 2, in chunks of the default
+# size of Pool.map
+def poolbatches(nworkers):
+    if nworkers < 2:
+        return 0
+    ntasks = nwalkers / 2
+    chunksize = int(math.ceil(ntasks / (4. * nworkers)))
+    return 2 * int(math.ceil(ntasks / float(chunksize)))
+
+
+if len(sys.argv) > 1:
+    maxworkers = int(sys.argv[1])
+else:
+    maxworkers = min(multiprocessing.cpu_count(), nwalkers / 2)
+if len(sys.argv) > 2:
+    niterations = int(sys.argv[2])
+else:
+    niterations = 10
+if len(sys.argv) > 3:
+    resultsloc = sys.argv[3]
+else:
+    resultsloc = 'uvscaling.json'
+
+workercounts = []
+nworkers = 1
+while nworkers < maxworkers:
+    workercounts.append(nworkers)
+    nworkers *= 2
+workercounts.append(maxworkers)
+
+backends = ['Threads']
+if haveMPI():
+    backends.append('MPI')
+else:
+    print 'mpirun or mpi4py not found; skipping MPI'
+
+serial = runserial()
+print 'One lnprob call: ' + str(serial['percall']) + ' s; pickling its ' + \
+        'arguments (' + str(serial['picklebytes'] / 1024. ** 2) + ' MB): ' + \
+        str(serial['pickletime']) + ' s'
+
+runs = []
+serialtime = None
+for backend in backends:
+    for nworkers in workercounts:
+        status = runbackend(backend, nworkers, niterations)
+        if status is None:
+            print backend + ' with ' + str(nworkers) + ' workers failed, ' + \
+                    'see ' + os.path.join(rundir, 'uvmcmcfit.log')
+            continue
+        run = {'backend': backend, 'workers': nworkers, \
+                'iterations': status['iteration'], \
+                'periteration': status['elapsed'] / status['iteration']}
+        if backend == 'Threads' and nworkers == 1:
+            serialtime = run['periteration']
+        workermemory = status.get('workermemory', {}).values()
+        if len(workermemory) > 0:
+            run['workermemory'] = max(workermemory)
+        else:
+            run['workermemory'] = status['peakmemory']
+        if backend == 'Threads':
+            run['serialisation'] = poolbatches(nworkers) * \
+                    serial['pickletime']
+        else:
+            run['serialisation'] = 0.
+        if serialtime is not None:
+            run['speedup'] = serialtime / run['periteration']
+            run['efficiency'] = run['speedup'] / nworkers
+            run['overhead'] = run['periteration'] - serialtime / nworkers
+        runs.append(run)
+
+        line = backend + ', ' + str(nworkers) + ' workers: ' + \
+                str(run['periteration']) + ' s per iteration'
+        if 'speedup' in run:
+            line += ', speedup ' + str(run['speedup']) + ', efficiency ' + \
+                    str(run['efficiency']) + ', overhead ' + \
+                    str(run['overhead']) + ' s (' + \
+                    str(run['serialisation']) + ' s pickling)'
+        line += ', ' + str(run['workermemory']) + ' MB per worker'
+        print line
+
+if len(runs) == 0:
+    sys.exit('No run succeeded')
+
+# the fastest run, or the one with the fewest workers within tolerance of it
+fastest = min([run['periteration'] for run in runs])
+good = [run for run in runs if run['periteration'] <= \
+        (1 + tolerance) * fastest]
+best = min(good, key=lambda run: (run['workers'], run['periteration']))
+if best['backend'] == 'MPI':
+    recommendation = "ParallelProcessingMode = 'MPI', with mpirun -np " + \
+            str(best['workers'] + 1)
+else:
+    recommendation = "ParallelProcessingMode = 'Threads', Nthreads = " + \
+            str(best['workers'])
+print 'Recommended for this machine: ' + recommendation + ' (' + \
+        str(best['periteration']) + ' s per iteration)'
+
+environment = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), \
+        'host': platform.node(), 'cores': multiprocessing.cpu_count(), \
+        'python': platform.python_version(), 'numpy': numpy.__version__}
+resultsfile = open(resultsloc, 'w')
+json.dump({'environment': environment, 'setup': setup, 'serial': serial, \
+        'runs': runs, 'recommendation': recommendation}, resultsfile, \
+        indent=1, sort_keys=True)
+resultsfile.close()
+print 'Results written to ' + resultsloc